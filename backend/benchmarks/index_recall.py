@@ -0,0 +1,77 @@
+"""
+Recall / latency report for the gallery index backends against exact brute force.
+
+Builds a synthetic gallery of unit-scale 128-d encodings (identities drawn around a
+shared mean, like dlib face descriptors) and probes it with noisy copies of enrolled
+faces. Run from the backend directory:
+
+    python benchmarks/index_recall.py --sizes 1000 10000 100000 --nprobe 4 8 16
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gallery_index import create_index  # noqa: E402
+
+
+def synthetic_gallery(size, seed=0):
+    rng = np.random.default_rng(seed)
+    mean = rng.normal(0.0, 0.09, 128)
+    return mean + rng.normal(0.0, 0.045, (size, 128))
+
+
+def probes_for(gallery, count, noise=0.02, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=count, replace=len(gallery) < count)
+    return gallery[rows] + rng.normal(0.0, noise, (count, 128))
+
+
+def time_search(index, gallery, probes, k):
+    rows = np.empty(len(probes), dtype=np.int64)
+    latencies = np.empty(len(probes))
+    for i, probe in enumerate(probes):
+        start = time.perf_counter()
+        _, found = index.search(gallery, probe[np.newaxis, :], k)
+        latencies[i] = time.perf_counter() - start
+        rows[i] = found[0, 0]
+    return rows, latencies * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'gallery':>8} {'backend':>12} {'build ms':>9} {'recall@1':>9} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in args.sizes:
+        gallery = synthetic_gallery(size)
+        probes = probes_for(gallery, args.queries)
+
+        brute = create_index('brute')
+        start = time.perf_counter()
+        brute.build(gallery)
+        build_ms = (time.perf_counter() - start) * 1000.0
+        truth, latencies = time_search(brute, gallery, probes, args.top_k)
+        print(f"{size:>8} {'brute':>12} {build_ms:>9.1f} {1.0:>9.3f} "
+              f"{np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 95):>8.3f}")
+
+        for nprobe in args.nprobe:
+            ivf = create_index('ivf', nprobe=nprobe, min_train_size=0)
+            start = time.perf_counter()
+            ivf.build(gallery)
+            build_ms = (time.perf_counter() - start) * 1000.0
+            found, latencies = time_search(ivf, gallery, probes, args.top_k)
+            recall = float(np.mean(found == truth))
+            print(f"{size:>8} {f'ivf/{nprobe}':>12} {build_ms:>9.1f} {recall:>9.3f} "
+                  f"{np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 95):>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
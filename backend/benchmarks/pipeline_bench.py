@@ -0,0 +1,257 @@
+"""
+Latency / throughput benchmark of the request pipelines on the bundled sample media.
+
+Runs the worker-side pipeline functions in this process, one call at a time, on
+the frames in videos/*frames/, static/known_faces/reference.jpg and the sample
+clips in videos/. Every call goes through metrics.collect(), so besides each
+pipeline's latency the report breaks it down into the same stages /metrics
+reports (detect, encode, match, facemesh, ...). Nothing under backend/ is
+modified: galleries and clips are copied to a temporary directory.
+
+Sections:
+  startup    FaceRecognizer cold (importing reference.jpg) and warm, init_worker
+  recognize  unlock_image with raw bytes and with a base64 data URL
+  enroll     add_face and encode_enrollment_image
+  video      upload_video, unlock_video, unlock_face, challenge_liveness
+  gallery    startup and recognize against synthetic galleries of --sizes faces
+
+Run from the backend directory:
+
+    python benchmarks/pipeline_bench.py --json results.json
+    python benchmarks/pipeline_bench.py --only gallery --sizes 1 1000 100000 --index ivf
+    python benchmarks/pipeline_bench.py --compare before.json after.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+import metrics  # noqa: E402
+import model_pool  # noqa: E402
+import pipelines  # noqa: E402
+from face_recognizer import FaceRecognizer, decode_image  # noqa: E402
+from gallery_store import GalleryStore, GALLERY_DB  # noqa: E402
+from index_recall import synthetic_gallery  # noqa: E402
+
+KNOWN_FACES = os.path.join(BACKEND, 'static', 'known_faces')
+VIDEOS = os.path.join(BACKEND, 'videos')
+SECTIONS = ('startup', 'recognize', 'enroll', 'video', 'gallery')
+
+
+def summarize(seconds):
+    ms = np.asarray(seconds) * 1000.0
+    return {
+        'count': int(ms.size),
+        'mean_ms': round(float(ms.mean()), 3),
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'per_s': round(float(ms.size / ms.sum() * 1000.0), 3) if ms.sum() else None,
+    }
+
+
+class Recorder:
+    """Per-call and per-stage timings, keyed by benchmark name."""
+
+    def __init__(self):
+        self.calls = {}
+        self.stages = {}
+
+    def run(self, name, fn, *args):
+        result, observations, seconds = metrics.collect(fn, *args)
+        self.record(name, seconds, observations)
+        return result
+
+    def time(self, name, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - start
+        self.record(name, seconds)
+        return result
+
+    def record(self, name, seconds, observations=()):
+        self.calls.setdefault(name, []).append(seconds)
+        for stage, stage_seconds in observations:
+            self.stages.setdefault(f"{name}/{stage}", []).append(stage_seconds)
+
+    def results(self):
+        return ({name: summarize(s) for name, s in self.calls.items()},
+                {name: summarize(s) for name, s in self.stages.items()})
+
+
+def legacy_gallery(parent):
+    """A copy of the bundled known_faces as shipped (reference.jpg + metadata, no database)."""
+    path = tempfile.mkdtemp(prefix='known_faces_', dir=parent)
+    for name in os.listdir(KNOWN_FACES):
+        if name.endswith('.jpg') or name == 'face_metadata.json':
+            shutil.copy(os.path.join(KNOWN_FACES, name), path)
+    return path
+
+
+def sample_images():
+    """(name, encoded bytes) of every bundled still: extracted frames and the reference photo."""
+    images = []
+    for folder in sorted(os.listdir(VIDEOS)):
+        folder_path = os.path.join(VIDEOS, folder)
+        if os.path.isdir(folder_path):
+            for name in sorted(os.listdir(folder_path)):
+                if name.endswith('.jpg'):
+                    with open(os.path.join(folder_path, name), 'rb') as f:
+                        images.append((f"{folder}/{name}", f.read()))
+    with open(os.path.join(KNOWN_FACES, 'reference.jpg'), 'rb') as f:
+        images.append(('known_faces/reference.jpg', f.read()))
+    return images
+
+
+def bench_startup(rec, workdir, repeat):
+    for _ in range(repeat):
+        gallery_dir = legacy_gallery(workdir)
+        rec.time('startup/recognizer_cold', FaceRecognizer, gallery_dir)
+        rec.time('startup/recognizer_warm', FaceRecognizer, gallery_dir)
+        model_pool.close_pools()
+        rec.time('startup/init_worker', pipelines.init_worker, gallery_dir)
+
+
+def bench_recognize(rec, images, repeat):
+    for _ in range(repeat):
+        for _, data in images:
+            rec.run('unlock_image', pipelines.unlock_image, data, 'none')
+            data_url = "data:image/jpeg;base64," + base64.b64encode(data).decode()
+            rec.run('unlock_image_base64_full', pipelines.unlock_image, data_url, 'full')
+
+
+def bench_enroll(rec, images, repeat):
+    faces = [data for _, data in images if pipelines.recognizer.detect_faces(decode_image(data))]
+    for _ in range(repeat):
+        for data in faces:
+            rec.run('encode_enrollment_image', pipelines.encode_enrollment_image, data)
+            rec.run('add_face', pipelines.add_face, data, 'benchmark')
+
+
+def bench_video(rec, workdir, repeat):
+    clips = os.path.join(workdir, 'videos')
+    os.makedirs(clips, exist_ok=True)
+    unlock_clip = shutil.copy(os.path.join(VIDEOS, 'unlock_face_video.webm'), clips)
+    challenge_clip = shutil.copy(os.path.join(VIDEOS, 'challenge_liveness_video.webm'), clips)
+    enroll_clip = shutil.copy(os.path.join(VIDEOS, 'face_video.webm'), clips)
+    for _ in range(repeat):
+        rec.run('upload_video', pipelines.upload_video, enroll_clip, 'benchmark')
+        rec.run('unlock_video', pipelines.unlock_video, unlock_clip, 'blink', 'none')
+        rec.run('unlock_face', pipelines.unlock_face, unlock_clip, None, 'none')
+        rec.run('challenge_liveness', pipelines.challenge_liveness, challenge_clip, 'show_two_fingers')
+
+
+def bench_gallery(rec, workdir, images, sizes, index, queries):
+    probes = [decode_image(data) for _, data in images[:queries]]
+    for size in sizes:
+        gallery_dir = tempfile.mkdtemp(prefix=f'gallery_{size}_', dir=workdir)
+        store = GalleryStore(os.path.join(gallery_dir, GALLERY_DB))
+        encodings = synthetic_gallery(size)
+        for start in range(0, size, 10000):
+            store.add([(f"person{i}", encodings[i], None) for i in range(start, min(start + 10000, size))])
+        store.close()
+
+        name = f'gallery/{size}'
+        index_params = {'min_train_size': 0} if index == 'ivf' else None
+        recognizer = rec.time(f'{name}/startup', FaceRecognizer, gallery_dir, index, index_params)
+        for img in probes:
+            rec.run(f'{name}/recognize', recognizer.recognize_frames, [img], None, 'none')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(title, summaries):
+    print(f"\n{title}")
+    print(f"{'':<48} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'per s':>8}")
+    for name, s in summaries.items():
+        print(f"{name:<48} {s['count']:>5} {s['p50_ms']:>9.2f} {s['p95_ms']:>9.2f} {s['p99_ms']:>9.2f} {s['per_s'] or 0:>8.2f}")
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+    print(f"{'':<48} {'p50 before':>11} {'p50 after':>10} {'change':>8}")
+    for section in ('calls', 'stages'):
+        for name, s in after[section].items():
+            old = before[section].get(name)
+            if old is None:
+                continue
+            change = (s['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100.0 if old['p50_ms'] else 0.0
+            print(f"{name:<48} {old['p50_ms']:>11.2f} {s['p50_ms']:>10.2f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the sample media')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 1000, 10000, 100000],
+                        help='synthetic gallery sizes')
+    parser.add_argument('--index', choices=('brute', 'ivf'), default='brute', help='gallery index for the gallery section')
+    parser.add_argument('--queries', type=int, default=10, help='probe images per gallery size')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two --json results and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    rec = Recorder()
+    images = sample_images()
+    with tempfile.TemporaryDirectory(prefix='face_bench_') as workdir:
+        # Warm-up: load the models once so the first timed call is not an outlier.
+        pipelines.init_worker(legacy_gallery(workdir))
+        pipelines.unlock_image(images[0][1], 'none')
+        if 'startup' in args.only:
+            bench_startup(rec, workdir, args.repeat)
+        if 'recognize' in args.only:
+            bench_recognize(rec, images, args.repeat)
+        if 'enroll' in args.only:
+            bench_enroll(rec, images, args.repeat)
+        if 'video' in args.only:
+            bench_video(rec, workdir, args.repeat)
+        if 'gallery' in args.only:
+            bench_gallery(rec, workdir, images, args.sizes, args.index, args.queries)
+
+    calls, stages = rec.results()
+    print_table('Calls', calls)
+    print_table('Stages', stages)
+    if args.json:
+        results = {
+            'meta': {
+                'commit': git_commit(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'args': {k: v for k, v in vars(args).items() if k not in ('json', 'compare')},
+            },
+            'calls': calls,
+            'stages': stages,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
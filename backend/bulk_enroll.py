@@ -0,0 +1,198 @@
+"""
+Bulk enrollment: add a whole directory or zip archive of face images at once.
+
+Names come from a names.csv manifest (rows of `file,name`, paths relative to the
+manifest) if there is one; otherwise from the folder an image sits in
+(`alice/1.jpg` -> "alice"), or from the file name for images at the top level.
+A folder wrapping all the per-person folders (`faces/alice/1.jpg`) does not count
+as the top level.
+
+Images are detected and encoded in parallel, one job per model worker, and the
+faces are then committed to the gallery in a single transaction, however many
+images there are. Images that cannot be decoded or have no face are reported and
+skipped.
+
+From the backend directory:
+    python bulk_enroll.py faces.zip [--workers 8] [--report report.json]
+or POST the zip to /bulk_enroll.
+"""
+import os
+import csv
+import io
+import json
+import posixpath
+import time
+import asyncio
+import zipfile
+import logging
+import argparse
+from executor import ExecutionLayer, ServerBusy, NotReady
+import pipelines
+import logging_config
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+MANIFEST = 'names.csv'
+# Upload limit for /bulk_enroll archives (other uploads use FACE_MAX_UPLOAD_MB)
+MAX_UPLOAD_BYTES = int(os.environ.get("FACE_BULK_MAX_UPLOAD_MB", "512")) * 1024 * 1024
+# Limit for each image once decompressed, the same as a single upload's
+MAX_IMAGE_BYTES = int(os.environ.get("FACE_MAX_UPLOAD_MB", "64")) * 1024 * 1024
+
+
+class EnrollmentSource:
+    """The images of a directory or zip archive, with the name to enroll each under."""
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.root = path
+            self.archive = None
+            self.files = sorted(os.path.relpath(os.path.join(d, f), path).replace(os.sep, '/')
+                                for d, _, names in os.walk(path) for f in names)
+        elif zipfile.is_zipfile(path):
+            self.root = None
+            self.archive = zipfile.ZipFile(path)
+            self.files = sorted(n for n in self.archive.namelist() if not n.endswith('/'))
+        else:
+            raise ValueError("Bulk enrollment needs a directory or a zip archive of images")
+
+    def read(self, member, max_bytes=MAX_IMAGE_BYTES):
+        # Read one byte past the limit rather than trusting the size in the zip header.
+        if self.archive is not None:
+            with self.archive.open(member) as f:
+                data = f.read(max_bytes + 1)
+        else:
+            with open(os.path.join(self.root, member), 'rb') as f:
+                data = f.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ValueError(f"Larger than {max_bytes // (1024 * 1024)} MB")
+        return data
+
+    def items(self):
+        """
+        Returns ([(member, name)] for every image to enroll, [(member, error)] for
+        manifest rows whose file is missing).
+        """
+        images = [f for f in self.files if f.lower().endswith(IMAGE_EXTENSIONS)]
+        manifests = sorted((f for f in self.files if posixpath.basename(f) == MANIFEST), key=lambda f: f.count('/'))
+        if not manifests:
+            # Name by the folder each image sits in, or by file name at the top level. A
+            # common folder holding only subfolders (faces/alice, faces/bob) is a wrapper
+            # and stripped; one holding the images themselves (alice/1.jpg) is their name.
+            base = posixpath.commonpath([posixpath.dirname(f) for f in images]) if images else ''
+            if any(posixpath.dirname(f) == base for f in images):
+                base = posixpath.dirname(base)
+            items = []
+            for member in images:
+                relative = posixpath.relpath(member, base) if base else member
+                folder = posixpath.dirname(relative)
+                items.append((member, posixpath.basename(folder) if folder else posixpath.splitext(posixpath.basename(member))[0]))
+            return items, []
+
+        base = posixpath.dirname(manifests[0])
+        available = set(images)
+        items, missing = [], []
+        for row in csv.reader(io.StringIO(self.read(manifests[0]).decode('utf-8-sig'))):
+            if len(row) < 2 or not row[0].strip() or row[0].strip().lower() == 'file':
+                continue
+            member = posixpath.join(base, row[0].strip()) if base else row[0].strip()
+            if member in available:
+                items.append((member, row[1].strip()))
+            else:
+                missing.append((member, f"Listed in {MANIFEST} but not found"))
+        return items, missing
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def _run_model(execution, fn, *args):
+    # Bulk jobs wait for a free slot instead of failing when live traffic fills the queue.
+    while True:
+        try:
+            return await execution.run_model(fn, *args)
+        except NotReady:
+            raise  # loading or stopped, not a full queue: waiting for a slot would not end
+        except ServerBusy as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def enroll(execution, source):
+    """Encode every image of `source` in parallel, then commit them all at once. Returns a report."""
+    started = time.monotonic()
+    items, failed = await execution.run_io(source.items)
+    failed = [{"file": member, "error": error} for member, error in failed]
+    # One job in flight per model worker keeps every core busy without filling the queue.
+    slots = asyncio.Semaphore(execution.model.workers)
+
+    async def encode(member):
+        async with slots:
+            data = await execution.run_io(source.read, member)
+            return await _run_model(execution, pipelines.encode_enrollment_image, data)
+
+    results = await asyncio.gather(*(encode(member) for member, _ in items), return_exceptions=True)
+    for result in results:
+        if isinstance(result, NotReady):
+            raise result
+
+    faces, accepted = [], []
+    for (member, name), result in zip(items, results):
+        if isinstance(result, Exception):
+            failed.append({"file": member, "error": str(result)})
+        else:
+            face_image, encoding = result
+            faces.append((face_image, encoding, name))
+            accepted.append((member, name))
+
+    face_ids = await _run_model(execution, pipelines.commit_enrollment, faces) if faces else []
+    enrolled = [{"file": member, "name": name, "face_id": face_id}
+                for (member, name), face_id in zip(accepted, face_ids)]
+    seconds = round(time.monotonic() - started, 2)
+    logger.info("Bulk enrollment: %d enrolled, %d failed in %ss", len(enrolled), len(failed), seconds)
+    return {
+        "success": bool(enrolled),
+        "total": len(enrolled) + len(failed),
+        "enrolled": enrolled,
+        "failed": failed,
+        "seconds": seconds
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll every face in a directory or zip archive of images.")
+    parser.add_argument("source", help="directory or .zip of images (optionally with a names.csv manifest)")
+    parser.add_argument("--known-faces", default="static/known_faces", help="gallery directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="encoding processes")
+    parser.add_argument("--report", help="write the JSON report to this file")
+    args = parser.parse_args()
+    logging_config.setup()
+
+    execution = ExecutionLayer(mode="process", model_workers=args.workers, max_queue=0,
+                               initializer=pipelines.init_worker, initargs=(args.known_faces,))
+    execution.start()
+    try:
+        while not execution.ready and not execution.broken:
+            time.sleep(0.1)
+        with EnrollmentSource(args.source) as source:
+            report = asyncio.run(enroll(execution, source))
+    except NotReady as e:
+        parser.exit(1, f"{e}\n")
+    finally:
+        execution.shutdown()
+
+    for failure in report["failed"]:
+        print(f"  {failure['file']}: {failure['error']}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
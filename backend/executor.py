@@ -0,0 +1,227 @@
+"""
+Executor layer that keeps CPU-bound model work and blocking I/O off the asyncio
+event loop.
+
+- Model work (dlib, MediaPipe, OpenCV decoding, ffmpeg) goes to a pool of worker
+  processes, each of which preloads its own FaceRecognizer via pipelines.init_worker.
+  FACE_EXECUTOR=thread runs the same work on a thread pool inside the server process
+  instead, which is handy for debugging and for platforms without cheap processes.
+- Blocking file I/O (saving uploads) goes to a small thread pool.
+
+Both pools are bounded: once every worker is busy and `max_queue` more jobs are
+waiting, new requests are rejected immediately with ServerBusy instead of piling up
+behind a slow video.
+
+start() only launches the workers; they load and warm up their models in the
+background while the server already accepts connections. Until every worker is
+warm (`ready`), model jobs are rejected with NotReady. So are they once a worker
+process has died: that breaks the whole process pool, and `ready` stays false so
+the readiness probe takes the instance out of rotation.
+"""
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import metrics
+import logging_config
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _init_worker(log_args, warm, initializer, initargs, workers=1):
+    # Worker processes log through the server's queue (see logging_config).
+    if log_args is not None:
+        logging_config.setup_worker(*log_args)
+    if initializer is not None:
+        initializer(*initargs)
+    # Shared with the server process, which reports readiness from it.
+    with warm.get_lock():
+        warm.value += workers
+
+
+def _in_request(request_id, fn, *args):
+    """Run fn(*args) with the submitting request's ID, so its log lines carry it."""
+    token = logging_config.request_id.set(request_id)
+    try:
+        return fn(*args)
+    finally:
+        logging_config.request_id.reset(token)
+
+
+class ServerBusy(Exception):
+    """Raised when a pool is saturated; endpoints turn this into a 503."""
+
+    def __init__(self, pool, retry_after=1):
+        super().__init__(f"The {pool} pool is saturated, please retry shortly.")
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class NotReady(ServerBusy):
+    """Raised while the model workers are still loading, or after they died; a 503 like ServerBusy."""
+
+    def __init__(self, retry_after=5, message="The models are still loading, please retry shortly."):
+        Exception.__init__(self, message)
+        self.pool = "model"
+        self.retry_after = retry_after
+
+
+class _BoundedPool:
+    def __init__(self, name, executor, workers, max_queue):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.in_flight = 0
+
+    async def run(self, fn, *args):
+        # Only the event loop thread touches in_flight, so no lock is needed.
+        if self.in_flight >= self.capacity:
+            metrics.REJECTED.inc(pool=self.name)
+            raise ServerBusy(self.name)
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+    @property
+    def busy(self):
+        return min(self.in_flight, self.workers)
+
+    @property
+    def queued(self):
+        return max(0, self.in_flight - self.workers)
+
+
+class ExecutionLayer:
+    def __init__(self, mode="process", model_workers=None, io_workers=4, max_queue=None,
+                 initializer=None, initargs=()):
+        model_workers = model_workers or max(1, min(4, (os.cpu_count() or 2) // 2))
+        max_queue = model_workers * 2 if max_queue is None else max_queue
+        # Workers done loading and warming up their models (see _init_worker).
+        self._warm = multiprocessing.get_context("spawn").Value("i", 0)
+        # Set when the thread-mode model load fails; a process pool marks itself broken.
+        self._init_failed = False
+
+        if mode == "process":
+            # spawn keeps MediaPipe/dlib state out of the server process and behaves the
+            # same on Linux and Windows.
+            model_executor = ProcessPoolExecutor(
+                max_workers=model_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(logging_config.worker_args(), self._warm, initializer, initargs),
+            )
+        elif mode == "thread":
+            model_executor = ThreadPoolExecutor(max_workers=model_workers, thread_name_prefix="model")
+        else:
+            raise ValueError(f"Unknown executor mode '{mode}', expected 'process' or 'thread'")
+
+        self.mode = mode
+        self._initializer = (initializer, initargs)
+        self.model = _BoundedPool("model", model_executor, model_workers, max_queue)
+        self.io = _BoundedPool("io", ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io"),
+                               io_workers, io_workers * 4)
+        pools = (self.model, self.io)
+        metrics.gauge('face_pool_workers', 'Workers in each pool.',
+                      lambda: {(p.name,): p.workers for p in pools}, ('pool',))
+        metrics.gauge('face_pool_busy', 'Workers currently running a job.',
+                      lambda: {(p.name,): p.busy for p in pools}, ('pool',))
+        metrics.gauge('face_pool_queued', 'Jobs waiting for a free worker.',
+                      lambda: {(p.name,): p.queued for p in pools}, ('pool',))
+        metrics.gauge('face_model_workers_ready', 'Model workers with their models loaded and warm.',
+                      lambda: self.warm_workers)
+        logger.info("ExecutionLayer: %d %s model workers, queue depth %d, %d I/O threads.",
+                    model_workers, mode, max_queue, io_workers)
+
+    @classmethod
+    def from_env(cls, initializer=None, initargs=()):
+        def env_int(name):
+            value = os.environ.get(name)
+            return int(value) if value else None
+
+        return cls(
+            mode=os.environ.get("FACE_EXECUTOR", "process"),
+            model_workers=env_int("FACE_MODEL_WORKERS"),
+            io_workers=env_int("FACE_IO_WORKERS") or 4,
+            max_queue=env_int("FACE_MAX_QUEUE"),
+            initializer=initializer,
+            initargs=initargs,
+        )
+
+    def start(self):
+        """
+        Spawn every model worker now so their models load before traffic arrives.
+        Returns immediately; `ready` turns true once all of them are warm.
+        """
+        if self.mode == "process":
+            # With no idle workers yet, each submit spawns a fresh process.
+            for _ in range(self.model.workers):
+                self.model.executor.submit(_worker_ready)
+        else:
+            # The threads share one set of models, loaded once on a model thread.
+            initializer, initargs = self._initializer
+            loading = self.model.executor.submit(_init_worker, None, self._warm, initializer, initargs,
+                                                 self.model.workers)
+            loading.add_done_callback(self._init_done)
+
+    def _init_done(self, future):
+        if future.exception() is not None:
+            logger.error("Loading the models failed", exc_info=future.exception())
+            self._init_failed = True
+
+    @property
+    def broken(self):
+        """True once a worker died (BrokenProcessPool) or failed to initialise; the pool takes no more jobs."""
+        return self._init_failed or bool(getattr(self.model.executor, "_broken", False))
+
+    @property
+    def warm_workers(self):
+        return 0 if self.broken else self._warm.value
+
+    @property
+    def ready(self):
+        return self.warm_workers >= self.model.workers
+
+    async def run_model(self, fn, *args):
+        if self.broken:
+            raise NotReady(message="The model workers have stopped; this instance needs a restart.")
+        if not self.ready:
+            raise NotReady()
+        # The worker times its stages (see metrics.collect); the rest of the
+        # elapsed time is queueing and the hand-off to the worker.
+        started = time.perf_counter()
+        try:
+            result, observations, seconds = await self.model.run(
+                _in_request, logging_config.request_id.get(), metrics.collect, fn, *args)
+        except ServerBusy:
+            raise
+        except Exception as e:
+            observations, seconds = getattr(e, 'stage_observations', ((), None))
+            metrics.record_job(fn.__name__, "error", observations, seconds, time.perf_counter() - started)
+            raise
+        metrics.record_job(fn.__name__, "ok", observations, seconds, time.perf_counter() - started)
+        return result
+
+    async def run_io(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            result = await self.io.run(_in_request, logging_config.request_id.get(), fn, *args)
+        except ServerBusy:
+            raise
+        except Exception:
+            metrics.IO_SECONDS.observe(time.perf_counter() - started, task=fn.__name__)
+            raise
+        metrics.IO_SECONDS.observe(time.perf_counter() - started, task=fn.__name__)
+        return result
+
+    def shutdown(self):
+        self.model.executor.shutdown(wait=False, cancel_futures=True)
+        self.io.executor.shutdown(wait=False, cancel_futures=True)
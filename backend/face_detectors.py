@@ -0,0 +1,115 @@
+"""
+Face detectors for FaceRecognizer. Every detector takes a BGR image and returns
+face boxes as (top, right, bottom, left) in full-resolution pixels, the order
+face_recognition uses.
+
+Measured on the bundled sample clips (one core, detection only):
+
+- hog (default): dlib's HOG detector. ~200 ms per frame at 640 px wide. The
+  boxes the reference encodings were made with.
+- haar: OpenCV's frontal-face Haar cascade on a 320 px grayscale copy. ~50 ms,
+  but misses more turned faces than HOG and gives looser boxes.
+- mediapipe: MediaPipe short-range face detection. ~3 ms and found a face in
+  every sample frame, but only for faces within ~2 m of the camera.
+
+Any of them can also serve as a pre-filter: a cheap detector that runs first so
+frames with no face skip the primary detector and the 128-d encoding.
+"""
+import os
+import cv2
+from model_pool import ModelPool
+
+DETECT_MAX_WIDTH = int(os.environ.get("FACE_DETECT_MAX_WIDTH", "640"))
+DETECT_UPSAMPLE = int(os.environ.get("FACE_DETECT_UPSAMPLE", "1"))
+# Retry detection with one more upsampling step when nothing is found (finds smaller faces, ~4x cost)
+DETECT_RETRY = os.environ.get("FACE_DETECT_RETRY") == "1"
+HAAR_CASCADE = os.environ.get("FACE_HAAR_CASCADE") or (cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+
+def _downscale(img, max_width):
+    """Return (img, scale): a copy at most max_width wide (0 = unchanged) and its scale factor."""
+    h, w = img.shape[:2]
+    if not max_width or w <= max_width:
+        return img, 1.0
+    scale = max_width / w
+    return cv2.resize(img, (max_width, max(1, round(h * scale))), interpolation=cv2.INTER_AREA), scale
+
+
+def _to_full_resolution(boxes, scale, shape):
+    """Map (top, right, bottom, left) boxes from a scaled copy back to an image of `shape`, clipped."""
+    h, w = shape[:2]
+    return [(max(int(top / scale), 0), min(int(right / scale), w),
+             min(int(bottom / scale), h), max(int(left / scale), 0))
+            for top, right, bottom, left in boxes]
+
+
+class HogDetector:
+    """
+    dlib HOG on a copy downscaled to max_width; detection cost scales with pixel
+    count, and faces are still encoded from the full-resolution image.
+    """
+
+    def __init__(self, max_width=DETECT_MAX_WIDTH, upsample=DETECT_UPSAMPLE, retry=DETECT_RETRY):
+        self.max_width = max_width
+        self.upsample = upsample
+        self.retry = retry
+
+    def detect(self, img):
+        import face_recognition  # loads dlib; see face_recognizer.py
+        small, scale = _downscale(img, self.max_width)
+        # The face_recognition library uses RGB images, but OpenCV uses BGR.
+        rgb_img = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        boxes = face_recognition.face_locations(rgb_img, number_of_times_to_upsample=self.upsample)
+        if not boxes and self.retry:
+            boxes = face_recognition.face_locations(rgb_img, number_of_times_to_upsample=self.upsample + 1)
+        return _to_full_resolution(boxes, scale, img.shape)
+
+
+class HaarDetector:
+    def __init__(self, max_width=320, scale_factor=1.1, min_neighbors=5, cascade_path=HAAR_CASCADE):
+        self.cascade = cv2.CascadeClassifier(cascade_path)
+        if self.cascade.empty():
+            raise ValueError(f"Could not load Haar cascade from {cascade_path} (set FACE_HAAR_CASCADE)")
+        self.max_width = max_width
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+
+    def detect(self, img):
+        small, scale = _downscale(img, self.max_width)
+        gray = cv2.equalizeHist(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors)
+        return _to_full_resolution([(y, x + w, y + h, x) for x, y, w, h in faces], scale, img.shape)
+
+
+class MediaPipeDetector:
+    def __init__(self, min_confidence=0.5, model_selection=0):
+        import mediapipe as mp
+        # Graphs are not safe to share between threads, so keep a small pool like the FaceMesh ones.
+        self.pool = ModelPool('face_detection', lambda: mp.solutions.face_detection.FaceDetection(
+            model_selection=model_selection, min_detection_confidence=min_confidence))
+
+    def detect(self, img):
+        h, w = img.shape[:2]
+        with self.pool.checkout() as detector:
+            results = detector.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        boxes = []
+        for detection in results.detections or []:
+            box = detection.location_data.relative_bounding_box
+            left, top = max(int(box.xmin * w), 0), max(int(box.ymin * h), 0)
+            right, bottom = min(int((box.xmin + box.width) * w), w), min(int((box.ymin + box.height) * h), h)
+            if right > left and bottom > top:
+                boxes.append((top, right, bottom, left))
+        return boxes
+
+
+DETECTORS = {
+    'hog': HogDetector,
+    'haar': HaarDetector,
+    'mediapipe': MediaPipeDetector,
+}
+
+
+def create_detector(name='hog', **params):
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector '{name}'. Choose from: {', '.join(DETECTORS)}")
+    return DETECTORS[name](**params)
@@ -1,56 +1,150 @@
 import cv2
 import numpy as np
 import base64
+import binascii
 import os
-import json
-from colorama import Fore, Style, init
-import re
-import face_recognition
+import time
+import logging
+import threading
+from gallery_store import GalleryStore, GALLERY_DB, migrate_legacy
+from shared_gallery import SharedGallery
+from gallery_index import create_index
+from face_detectors import create_detector
+import metrics
+import logging_config
 
-init(autoreset=True)
+logger = logging.getLogger(__name__)
+
+# face_recognition loads dlib and its model files on import, so it is imported where
+# it is used: the server process only hands requests to the workers and never needs it.
+
+# face_recognition.compare_faces default: distances at or below this count as a match.
+MATCH_TOLERANCE = 0.6
+ENCODING_SIZE = 128
+# Face detector ('hog', 'haar' or 'mediapipe', see face_detectors.py) and an optional
+# cheap pre-filter that rejects faceless frames before the detector runs.
+DETECTOR = os.environ.get("FACE_DETECTOR", "hog")
+PREFILTER = os.environ.get("FACE_PREFILTER") or None
+# Ignore detected faces shorter than this many pixels at full resolution
+MIN_FACE_SIZE = int(os.environ.get("FACE_MIN_FACE_SIZE", "0"))
+# What recognition returns as processed_image: the annotated frame as a full-size JPEG,
+# a small annotated thumbnail, or nothing (the structured box/identity/score only).
+RESPONSE_MODES = ('full', 'thumbnail', 'none')
+THUMBNAIL_WIDTH = int(os.environ.get("FACE_THUMBNAIL_WIDTH", "320"))
+THUMBNAIL_QUALITY = int(os.environ.get("FACE_THUMBNAIL_QUALITY", "70"))
+# How often a worker checks the shared segment against the database, in case a writer
+# died between committing a change and applying it to the segment.
+GALLERY_CHECK_SECONDS = float(os.environ.get("FACE_GALLERY_CHECK_SECONDS", "5"))
 
 class FaceRecognizer:
-    def __init__(self, reference_dir):
-        print(Fore.CYAN + "FaceRecognizer: Initializing..." + Style.RESET_ALL)
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        if self.face_cascade.empty():
-            print(Fore.RED + "FaceRecognizer: ERROR: Could not load face cascade." + Style.RESET_ALL)
-        else:
-            print(Fore.GREEN + "FaceRecognizer: Face cascade loaded." + Style.RESET_ALL)
-        
-        self.reference_faces = {}
+    def __init__(self, reference_dir, index_backend='brute', index_params=None, top_k=5,
+                 detector=DETECTOR, prefilter=PREFILTER, min_face_size=MIN_FACE_SIZE):
+        logger.info("FaceRecognizer: Initializing...")
+        self.detector = create_detector(detector)
+        self.prefilter = None
+        if prefilter:
+            try:
+                self.prefilter = create_detector(prefilter)
+                logger.info("FaceRecognizer: %s pre-filter loaded.", prefilter)
+            except ValueError as e:
+                logger.error("FaceRecognizer: %s; running without a pre-filter.", e)
+
+        # The gallery's encodings and names, mapped read-only from the segment every
+        # process shares (shared_gallery.py); gallery_encodings is its (N, 128) view,
+        # tombstones (`_removed`) included, and gallery_size the faces that are left.
+        self.gallery = None
+        self.gallery_encodings = np.empty((0, ENCODING_SIZE), dtype=np.float64)
+        self.gallery_size = 0
+        self._removed = np.zeros(0, dtype=bool)
+        self._gallery_version = None
+        self._gallery_checked = time.monotonic()
+        # Model threads share one recognizer (FACE_EXECUTOR=thread): the lock keeps a
+        # refresh from swapping the gallery or updating the index under a search.
+        self._gallery_lock = threading.Lock()
         self.reference_dir = reference_dir
-        self.metadata_file = os.path.join(reference_dir, 'face_metadata.json')
         os.makedirs(reference_dir, exist_ok=True)
+        self.gallery_store = GalleryStore(os.path.join(reference_dir, GALLERY_DB))
+        # Nearest-neighbour index over gallery_encodings ('brute' or 'ivf', see gallery_index.py)
+        self.index = create_index(index_backend, **(index_params or {}))
+        self.top_k = top_k
+        self.min_face_size = min_face_size
         self._load_all_reference_faces()
 
         self.colors = {
             'Match': (0, 255, 0),
             'No Match': (0, 0, 255)
         }
-        print(Fore.CYAN + "FaceRecognizer: Initialization complete." + Style.RESET_ALL)
+        logger.info("FaceRecognizer: Initialization complete.")
 
     def _load_all_reference_faces(self):
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r') as f:
-                metadata = json.load(f)
-        else:
-            metadata = {}
-
-        for filename in os.listdir(self.reference_dir):
-            if filename.endswith('.jpg') and filename != 'face_metadata.json':
-                img_path = os.path.join(self.reference_dir, filename)
-                try:
-                    face_data = self._load_reference_face(img_path)
-                    if face_data is not None:
-                        self.reference_faces[filename] = {
-                            'face': face_data,
-                            'name': metadata.get(filename, 'Unknown')
-                        }
-                except Exception as e:
-                    print(Fore.RED + f"Error loading {filename}: {e}" + Style.RESET_ALL)
+        # One-time import of a gallery kept as loose JPEGs + face_metadata.json
+        if not self.gallery_store.migrated():
+            migrate_legacy(self.gallery_store, self.reference_dir, self._load_reference_face)
+
+        self._open_gallery()
+        logger.info("FaceRecognizer: Loaded %d reference faces.", self.gallery_size)
+
+    def _open_gallery(self):
+        """
+        Map the current gallery segment (bringing it up to date first). A segment that
+        grew out of the one already mapped keeps its rows, so only its changes are
+        indexed; anything else is indexed from scratch.
+        """
+        gallery = None
+        while gallery is None or not gallery.current:  # another process may rebuild it meanwhile
+            self.gallery_store.sync_segment()
+            gallery = SharedGallery.open_latest(self.reference_dir)
+        previous, self.gallery = self.gallery, gallery
+        if previous is not None and previous.layout == gallery.layout:
+            self.gallery_encodings = gallery.encodings[:len(self.gallery_encodings)]
+            self._index_changes()
+            return
+        # The version first: rows changed after it are indexed again on the next refresh.
+        self._gallery_version = gallery.version
+        count = gallery.count
+        self.gallery_encodings = gallery.encodings[:count]
+        self._removed = ~gallery.alive(count)
+        self.gallery_size = count - int(self._removed.sum())
+        self.index.build(self.gallery_encodings, np.flatnonzero(self._removed))
+
+    def _index_changes(self):
+        """Index the rows appended and drop the rows removed since the last version seen."""
+        self._gallery_version = self.gallery.version
+        known, count = len(self.gallery_encodings), self.gallery.count
+        for row in range(known, count):
+            self.index.add(row, self.gallery.encodings[row])
+        self.gallery_encodings = self.gallery.encodings[:count]
+        removed = ~self.gallery.alive(count)
+        newly_removed = removed.copy()
+        newly_removed[:known] &= ~self._removed
+        for row in np.flatnonzero(newly_removed):
+            self.index.remove(row)
+        self._removed = removed
+        self.gallery_size = count - int(removed.sum())
+
+    def refresh(self):
+        """
+        Apply faces added, renamed or removed (by this or another process) since the
+        last call. A look at the shared segment's header; only appended and removed
+        rows touch the index, and names are read from the segment when a face matches.
+        Every GALLERY_CHECK_SECONDS the segment's version is also compared with the
+        database's, and a change that never reached the segment is applied.
+        """
+        with metrics.stage('gallery_refresh'), self._gallery_lock:
+            now = time.monotonic()
+            if now - self._gallery_checked >= GALLERY_CHECK_SECONDS:
+                self._gallery_checked = now
+                if self.gallery.version < self.gallery_store.version():
+                    logger.warning("Gallery segment is behind the database; updating it.")
+                    self.gallery_store.sync_segment()
+            if not self.gallery.current:
+                # Grown or compacted into a new generation
+                self._open_gallery()
+            elif self.gallery.version != self._gallery_version:
+                self._index_changes()
 
     def _load_reference_face(self, img_path):
+        import face_recognition
         img = face_recognition.load_image_file(img_path)
         encodings = face_recognition.face_encodings(img)
 
@@ -60,18 +154,53 @@ class FaceRecognizer:
         return encodings[0]
 
     def add_reference_face(self, base64_image, name):
-        img_data = base64.b64decode(base64_image.split(',')[-1])
-        np_arr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
+        img = decode_base64_image(base64_image)
         if img is None:
             raise Exception("Could not decode image from base64")
+        return self.add_reference_face_array(img, name)
 
-        # The face_recognition library uses RGB images, but OpenCV uses BGR.
-        # So, we need to convert from BGR to RGB.
-        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        face_locations = face_recognition.face_locations(rgb_img)
+    def detect_faces(self, img):
+        """
+        Find faces in a BGR image; boxes are (top, right, bottom, left) in full-resolution
+        pixels. Frames the pre-filter sees no face in never reach the detector.
+        """
+        if self.prefilter is not None:
+            with metrics.stage('prefilter'):
+                if not self.prefilter.detect(img):
+                    return []
+        with metrics.stage('detect'):
+            boxes = self.detector.detect(img)
+        return [box for box in boxes if box[2] - box[0] >= self.min_face_size]
+
+    def encode_faces(self, img, face_locations):
+        """
+        128-d encodings for the given boxes. Each face is encoded from a full-resolution
+        crop around its box, so only that region is converted to RGB.
+        """
+        import face_recognition
+        h, w = img.shape[:2]
+        encodings = []
+        with metrics.stage('encode'):
+            for top, right, bottom, left in face_locations:
+                # dlib's landmark fit and face chip reach a little outside the box
+                margin_y, margin_x = (bottom - top) // 2, (right - left) // 2
+                y0, y1 = max(top - margin_y, 0), min(bottom + margin_y, h)
+                x0, x1 = max(left - margin_x, 0), min(right + margin_x, w)
+                crop = cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2RGB)
+                box = (top - y0, right - x0, bottom - y0, left - x0)
+                encodings.append(face_recognition.face_encodings(crop, [box])[0])
+        return encodings
+
+    def add_reference_face_array(self, img, name):
+        face_image, encoding = self.encode_reference_face(img)
+        return self.add_reference_faces([(face_image, encoding, name)])[0]
+
+    def encode_reference_face(self, img):
+        """
+        Detect and encode the face to enroll from a BGR image. Returns the JPEG-encoded
+        face crop that is kept in the gallery and the 128-d encoding of the face.
+        """
+        face_locations = self.detect_faces(img)
         if not face_locations:
             raise Exception("No face found in the image")
 
@@ -79,98 +208,143 @@ class FaceRecognizer:
         # but we'll use encodings for comparison.
         top, right, bottom, left = face_locations[0]
         face_roi = img[top:bottom, left:right]
+        encoding = self.encode_faces(img, face_locations[:1])[0]
+        with metrics.stage('jpeg_encode'):
+            _, buffer = cv2.imencode('.jpg', face_roi)
+        return buffer.tobytes(), encoding
 
-        # Find the lowest available reference number
-        existing_numbers = set()
-        for fname in os.listdir(self.reference_dir):
-            match = re.match(r'reference(\\d*)\\.jpg', fname)
-            if match:
-                num = match.group(1)
-                if num == '':
-                    existing_numbers.add(0)
-                else:
-                    existing_numbers.add(int(num))
-        i = 1
-        while i in existing_numbers:
-            i += 1
-        face_id = f"reference{i}"
-        face_filename = f"{face_id}.jpg"
-        face_path = os.path.join(self.reference_dir, face_filename)
-        cv2.imwrite(face_path, face_roi)
-
-        metadata = {}
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r') as f:
-                metadata = json.load(f)
-
-        metadata[face_filename] = name
-        with open(self.metadata_file, 'w') as f:
-            json.dump(metadata, f)
-
-        # Reload all faces to update the encodings in memory
-        self._load_all_reference_faces()
+    def add_reference_faces(self, faces):
+        """
+        Enroll (face_image, encoding, name) tuples, as made by encode_reference_face(),
+        in one gallery transaction. Returns the new face ids in order.
+        """
+        with metrics.stage('gallery_write'):
+            face_ids = self.gallery_store.add([(name, encoding, face_image) for face_image, encoding, name in faces])
+        # Picks up the new rows, and anything other processes changed meanwhile.
+        self.refresh()
+        for face_id, (_, _, name) in zip(face_ids, faces):
+            logger.info("Added face for %s with ID: %s", name, face_id)
+        return face_ids
 
-        print(Fore.GREEN + f"Added face for {name} with ID: {face_filename}" + Style.RESET_ALL)
-        return face_id
+    def rename_reference_face(self, face_id, name):
+        """Returns False if there is no such face."""
+        renamed = self.gallery_store.rename(face_id, name)
+        self.refresh()
+        return renamed
 
-    def _compare_faces(self, known_encoding, unknown_encoding):
+    def remove_reference_face(self, face_id):
+        """Returns False if there is no such face."""
+        removed = self.gallery_store.remove(face_id)
+        self.refresh()
+        return removed
+
+    def _search_gallery(self, unknown_encodings):
         """
-        Compare a list of face encodings against a candidate encoding to see if they match.
+        Find the top_k closest references for each candidate encoding using the
+        configured index, then re-rank them with exact euclidean distance (the same
+        metric as face_recognition.face_distance) so thresholds do not depend on
+        the index backend. Returns (M, top_k) distances and gallery rows; missing
+        neighbours are padded with inf / -1.
         """
-        # Returns a list of True/False values.
-        matches = face_recognition.compare_faces([known_encoding], unknown_encoding)
-        
-        # face_distance returns a score for each face, the lower the score the more similar.
-        # A typical cutoff for strict systems is 0.6.
-        face_dist = face_recognition.face_distance([known_encoding], unknown_encoding)[0]
-        
-        # We'll convert distance to similarity: 1 - distance
-        similarity = 1 - face_dist
-        
-        return matches[0], similarity
+        unknown = np.asarray(unknown_encodings, dtype=np.float64).reshape(-1, ENCODING_SIZE)
+        index_distances, rows = self.index.search(self.gallery_encodings, unknown, self.top_k)
+        valid = (rows >= 0) & np.isfinite(index_distances)  # removed rows come back at inf
+        neighbours = self.gallery_encodings[np.where(valid, rows, 0)]
+        distances = np.linalg.norm(neighbours - unknown[:, np.newaxis, :], axis=2)
+        distances[~valid] = np.inf
+        return distances, rows
 
-    def recognize(self, base64_image):
-        print(Fore.CYAN + "Starting recognition..." + Style.RESET_ALL)
-        if not self.reference_faces:
+    def recognize(self, base64_image, response='full'):
+        if not self.gallery_size:
             return "No Match", 0.0, None, "Unknown"
-
-        img_data = base64.b64decode(base64_image.split(',')[-1])
-        np_arr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
+        img = decode_base64_image(base64_image)
         if img is None:
             return "No Match", 0.0, None, "Unknown"
+        return self.recognize_array(img, response=response)
+
+    def recognize_array(self, img, face_locations=None, response='full'):
+        """Recognize the best face in a decoded BGR image; same result tuple as recognize()."""
+        return self.recognize_batch([img], [face_locations], response)
+
+    def recognize_batch(self, frames, face_locations=None, response='full'):
+        """Like recognize_frames(), as a (status, similarity, processed_image, name) tuple."""
+        result = self.recognize_frames(frames, face_locations, response)
+        return result['status'], result['similarity'], result['processed_image'], result['name']
+
+    def recognize_frames(self, frames, face_locations=None, response='full'):
+        """
+        Recognize a list of decoded BGR frames and return the result of the
+        best-scoring frame (frames with a face first, then by similarity, the
+        earliest one on ties) as a dict with status, similarity, name, box
+        ({'x', 'y', 'width', 'height'} of the matched face, or None) and
+        processed_image. Only that frame is annotated and encoded, as
+        `response` asks: 'full', 'thumbnail' or 'none'.
+
+        face_locations, if given, holds one entry per frame: a list of known
+        (top, right, bottom, left) boxes, which skips detection for that frame, or
+        None to run the detector.
+        """
+        if face_locations is None:
+            face_locations = [None] * len(frames)
+        best = None
+        for img, known_locations in zip(frames, face_locations):
+            match = self._match_array(img, known_locations)
+            # A frame with a face, even an unmatched one (-1), beats a faceless one (0.0).
+            if best is None or (match['scored'], match['similarity']) > (best['scored'], best['similarity']):
+                best = match
+        result = {'status': "No Match", 'similarity': 0.0, 'name': "Unknown", 'box': None, 'processed_image': None}
+        if best is None or not best['scored']:
+            return result
+        result.update(status=best['status'], similarity=best['similarity'], name=best['name'])
+        if best['location']:
+            top, right, bottom, left = best['location']
+            result['box'] = {'x': left, 'y': top, 'width': right - left, 'height': bottom - top}
+        if response != 'none':
+            result['processed_image'] = self._annotate(best['image'], best, response == 'thumbnail')
+        return result
 
-        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        face_locations = face_recognition.face_locations(rgb_img)
-        unknown_encodings = face_recognition.face_encodings(rgb_img, face_locations)
+    def _match_array(self, img, known_locations=None):
+        """
+        Match the faces in one BGR image against the gallery without touching the
+        image. 'scored' is False when there was nothing to score (empty gallery or
+        no face), which recognize() reports as similarity 0.0 with no image.
+        """
+        result = {'image': img, 'status': "No Match", 'similarity': 0.0, 'name': "Unknown",
+                  'location': None, 'scored': False}
+        if not self.gallery_size:
+            return result
+
+        face_locations = known_locations or self.detect_faces(img)
+        unknown_encodings = self.encode_faces(img, face_locations)
 
         if not unknown_encodings:
-            return "No Match", 0.0, None, "Unknown"
+            return result
 
         best_similarity = -1
         best_match_name = "Unknown"
         best_location = None
-        match_status = "No Match"
-
-        # Loop through all the faces found in the unknown image
-        for i, unknown_encoding in enumerate(unknown_encodings):
-            top, right, bottom, left = face_locations[i]
-            
-            # See if the face is a match for the known face(s)
-            for face_id, face_data in self.reference_faces.items():
-                known_encoding = face_data['face'] # This is now an encoding
-                
-                is_match, similarity = self._compare_faces(known_encoding, unknown_encoding)
-                
-                print(Fore.CYAN + f"Similarity with {face_data['name']}: {similarity:.2f}" + Style.RESET_ALL)
-
-                if is_match and similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match_name = face_data['name']
-                    best_location = (top, right, bottom, left)
-        
+
+        # Score all faces found in the unknown image against the gallery at once.
+        # We'll convert distance to similarity: 1 - distance
+        # The rows are only meaningful for the gallery they were found in: hold the
+        # lock until the name is read.
+        with metrics.stage('match'), self._gallery_lock:
+            distances, rows = self._search_gallery(unknown_encodings)
+            similarities = 1 - distances
+            # Only pairs that face_recognition.compare_faces would accept are candidates.
+            candidates = np.where(distances <= MATCH_TOLERANCE, similarities, -np.inf)
+            face_idx, neighbour = np.unravel_index(np.argmax(candidates), candidates.shape)
+
+            if np.isfinite(candidates[face_idx, neighbour]):
+                best_similarity = float(candidates[face_idx, neighbour])
+                best_match_name = self.gallery.name(rows[face_idx, neighbour])
+                best_location = face_locations[face_idx]
+
+        # Per-frame detail: only a sample of calls, and only at DEBUG.
+        if logging_config.sampled(logger):
+            logger.debug("Best similarity of %d faces over %d references: %.2f",
+                         len(unknown_encodings), self.gallery_size, similarities.max())
+
         # A typical threshold for face_recognition library is around 0.6 for distance.
         # Since we converted it to similarity (1 - distance), our threshold will be 0.4.
         # Let's be a bit stricter, let's use 0.5
@@ -180,16 +354,64 @@ class FaceRecognizer:
             match_status = "No Match"
             best_match_name = "Unknown"
 
-        if best_location:
-            top, right, bottom, left = best_location
+        result.update(status=match_status, similarity=best_similarity, name=best_match_name,
+                      location=best_location, scored=True)
+        return result
+
+    def _annotate(self, img, match, thumbnail=False):
+        """
+        Draw the match box and label on a copy of img and return it as base64 JPEG.
+        A thumbnail is shrunk to THUMBNAIL_WIDTH before drawing and saved at THUMBNAIL_QUALITY.
+        """
+        scale, font_scale, encode_params = 1.0, 0.8, []
+        if thumbnail:
+            h, w = img.shape[:2]
+            if w > THUMBNAIL_WIDTH:
+                scale = THUMBNAIL_WIDTH / w
+                img = cv2.resize(img, (THUMBNAIL_WIDTH, max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+            font_scale = 0.5
+            encode_params = [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY]
+
+        if match['location']:
+            if scale == 1.0:
+                img = img.copy()
+            top, right, bottom, left = (int(v * scale) for v in match['location'])
             x, y, w, h = left, top, right - left, bottom - top # Convert to x,y,w,h for cv2.rectangle
-            
-            color = self.colors[match_status]
-            label = f"{best_match_name} ({best_similarity:.2f})"
+
+            color = self.colors[match['status']]
+            label = f"{match['name']} ({match['similarity']:.2f})"
             cv2.rectangle(img, (x, y), (x+w, y+h), color, 2)
-            cv2.putText(img, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+            cv2.putText(img, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, font_scale, color, 2)
+
+        with metrics.stage('jpeg_encode'):
+            _, buffer = cv2.imencode('.jpg', img, encode_params)
+            return base64.b64encode(buffer).decode('utf-8')
+
+
+def base64_image_bytes(base64_image):
+    """The encoded image bytes of a (data URL or bare) base64 image; ValueError if it is not base64."""
+    try:
+        return base64.b64decode(base64_image.split(',')[-1])
+    except binascii.Error as e:
+        raise ValueError(f"The image is not valid base64: {e}") from e
+
+
+def decode_base64_image(base64_image):
+    """Decode a (data URL or bare) base64 image into a BGR array, or None."""
+    with metrics.stage('base64_decode'):
+        img_data = base64_image_bytes(base64_image)
+    return decode_image_bytes(img_data)
+
+
+def decode_image_bytes(img_data):
+    """Decode encoded image bytes (JPEG, PNG, ...) into a BGR array, or None."""
+    np_arr = np.frombuffer(img_data, np.uint8)
+    with metrics.stage('imdecode'):
+        return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
 
-        _, buffer = cv2.imencode('.jpg', img)
-        processed_image = base64.b64encode(buffer).decode('utf-8')
 
-        return match_status, best_similarity, processed_image, best_match_name
+def decode_image(image):
+    """Decode either raw image bytes or a base64 string, as the upload endpoints receive them."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image_bytes(image)
+    return decode_base64_image(image)
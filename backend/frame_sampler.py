@@ -0,0 +1,346 @@
+"""
+Frame sampling for the video endpoints.
+
+Frames come back as decoded BGR numpy arrays; nothing is written to disk unless
+FACE_DEBUG_FRAMES=1, in which case the sampled frames are also dumped as JPEGs
+for inspection (the old videos/*_frames/ layout).
+
+OpenCV decodes the video when it reports a usable frame count. Browser WebM
+usually does not, and then ffmpeg decodes it instead: the frame count comes from
+a stream-copy pass (no decoding), and the selected frames are piped out as raw
+BGR without any intermediate file.
+
+The frames kept for FaceMesh/Hands follow the motion in the clip
+(FACE_FRAME_SAMPLING=motion, the default). As the video is decoded, in the same
+single pass, each frame is shrunk to a 160x120 grey thumbnail and compared with the
+previous one block by block, so a blink or a hand registers even when the rest of
+the picture is still. Frames that barely differ from the last kept one are dropped,
+and the FACE_FRAME_BUDGET frames (default 8) go to the moments around the largest
+changes, plus a few spread over the clip; a still clip yields only its few distinct
+frames. FACE_FRAME_SAMPLING=uniform takes FACE_FRAME_BUDGET evenly spaced frames
+instead (default 10, as before motion sampling).
+"""
+import os
+import re
+import logging
+import subprocess
+import cv2
+import numpy as np
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEBUG_FRAMES = os.environ.get("FACE_DEBUG_FRAMES") == "1"
+# Downscale ffmpeg-decoded frames wider than this (0 keeps the source size). The
+# liveness thresholds are in pixels, so change this together with them.
+DECODE_MAX_WIDTH = int(os.environ.get("FACE_DECODE_MAX_WIDTH", "0"))
+MAX_FRAMES = 10000
+SAMPLING_MODES = ('motion', 'uniform')
+DEFAULT_BUDGETS = {'motion': 8, 'uniform': 10}
+FRAME_SAMPLING = os.environ.get("FACE_FRAME_SAMPLING", "motion")
+if FRAME_SAMPLING not in SAMPLING_MODES:
+    raise ValueError(f"FACE_FRAME_SAMPLING must be one of: {', '.join(SAMPLING_MODES)}")
+FRAME_BUDGET = int(os.environ.get("FACE_FRAME_BUDGET") or DEFAULT_BUDGETS[FRAME_SAMPLING])
+if FRAME_BUDGET < 1:
+    raise ValueError("FACE_FRAME_BUDGET must be at least 1")
+MOTION_SIZE = (160, 120)
+MOTION_BLOCK = 8
+MOTION_SPACING = 3
+# A frame whose largest block change from the last kept frame is below this many grey
+# levels is a near-duplicate of it.
+DUPLICATE_THRESHOLD = float(os.environ.get("FACE_DUPLICATE_THRESHOLD", "8"))
+# Video luma spans 16..235, so the same change is this much smaller than in a BGR grey image.
+LUMA_RANGE = 219 / 255
+
+
+def _frame_count_ok(cap, total_frames):
+    return cap.isOpened() and total_frames is not None and 0 < total_frames <= MAX_FRAMES
+
+
+def open_video(video_path):
+    """
+    Open a video with OpenCV. Returns (cap, total_frames), or (None, 0) when
+    OpenCV cannot open it or reports no usable frame count.
+    """
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    logger.debug("Total frames in video: %d", total_frames)
+    if not _frame_count_ok(cap, total_frames):
+        cap.release()
+        return None, 0
+    return cap, total_frames
+
+
+def probe_video(video_path, count_frames=True):
+    """
+    Read the frame size, as displayed (after any rotation in the metadata), and
+    the frame count with ffmpeg alone. The count comes from
+    stream-copying the video packets to a null muxer, which never decodes; it is
+    0 with count_frames=False. Returns (width, height, total_frames); all zero if
+    ffmpeg cannot read it.
+    """
+    info = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostdin", "-i", video_path],
+        capture_output=True, text=True
+    ).stderr
+    size = re.search(r"Video:.*?\b(\d{2,5})x(\d{2,5})\b", info)
+    if not size:
+        return 0, 0, 0
+    width, height = int(size.group(1)), int(size.group(2))
+    # ffmpeg applies the rotation (phone clips), so a quarter turn swaps the decoded size.
+    rotation = re.search(r"displaymatrix: rotation of (-?[\d.]+) degrees|\brotate\s*:\s*(-?\d+)", info)
+    if rotation and round(float(rotation.group(1) or rotation.group(2))) % 180 == 90:
+        width, height = height, width
+    if not count_frames:
+        return width, height, 0
+    packets = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-i", video_path,
+         "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"],
+        capture_output=True, text=True
+    ).stdout
+    total_frames = sum(1 for line in packets.splitlines() if line and not line.startswith("#"))
+    return width, height, total_frames
+
+
+def _ffmpeg_raw(video_path, filters, pix_fmt, shape):
+    """
+    Yield the frames ffmpeg decodes through `filters`, piped out as raw `pix_fmt`
+    arrays of `shape`. The arrays are read-only views of the pipe buffer.
+    """
+    proc = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error",
+         "-i", video_path, "-map", "0:v:0", "-vf", ",".join(filters), "-vsync", "0",
+         "-f", "rawvideo", "-pix_fmt", pix_fmt, "pipe:1"],
+        stdout=subprocess.PIPE
+    )
+    frame_bytes = int(np.prod(shape))
+    try:
+        while True:
+            buf = proc.stdout.read(frame_bytes)
+            if len(buf) < frame_bytes:
+                break
+            yield np.frombuffer(buf, np.uint8).reshape(shape)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def _scale_filters(width, height, max_width):
+    """ffmpeg filters for the optional downscale to max_width, and the resulting size."""
+    if max_width and width > max_width:
+        height = int(round(height * max_width / width / 2)) * 2
+        width = max_width
+        return [f"scale={width}:{height}"], width, height
+    return [], width, height
+
+
+def ffmpeg_frames(video_path, indices, width, height, max_width=DECODE_MAX_WIDTH):
+    """
+    Yield the requested frames (in index order) decoded by ffmpeg and piped out as
+    raw BGR. Frame selection and optional downscaling happen inside ffmpeg.
+    """
+    if not indices:
+        return
+    scale, width, height = _scale_filters(width, height, max_width)
+    filters = ["select='" + "+".join(f"eq(n\\,{i})" for i in sorted(set(indices))) + "'"] + scale
+    for frame in _ffmpeg_raw(video_path, filters, "bgr24", (height, width, 3)):
+        yield frame.copy()
+
+
+def decode_frames(video_path, choose_indices):
+    """
+    Decode the frames picked by choose_indices(total_frames). Uses OpenCV when it
+    can index the video and the ffmpeg pipe otherwise. Returns a list of frames,
+    or None if neither decoder can read the video.
+    """
+    with metrics.stage('video_decode'):
+        cap, total_frames = open_video(video_path)
+        if cap is not None:
+            try:
+                return read_frames(cap, choose_indices(total_frames))
+            finally:
+                cap.release()
+
+    logger.info("OpenCV cannot index this video, decoding through an ffmpeg pipe...")
+    with metrics.stage('ffmpeg_decode'):
+        width, height, total_frames = probe_video(video_path)
+        logger.debug("Total frames from ffmpeg: %d", total_frames)
+        if not 0 < total_frames <= MAX_FRAMES:
+            return None
+        return list(ffmpeg_frames(video_path, choose_indices(total_frames), width, height))
+
+
+def _opencv_all_frames(cap):
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                return
+            yield frame
+    finally:
+        cap.release()
+
+
+def all_frames(video_path):
+    """
+    Every frame of the video in order, as a generator that decodes as it is consumed,
+    from OpenCV or else the ffmpeg pipe. Returns (frames, i420, stage name for timing),
+    or (None, False, None) if neither decoder can read the video. With i420 the frames
+    are planar YUV 4:2:0 (to_bgr() converts them), otherwise BGR.
+    """
+    cap, _ = open_video(video_path)
+    if cap is not None:
+        return _opencv_all_frames(cap), False, 'video_decode'
+    logger.info("OpenCV cannot index this video, decoding through an ffmpeg pipe...")
+    width, height, _ = probe_video(video_path, count_frames=False)
+    if not width:
+        return None, False, None
+    # No frame count needed: the pass below sees every frame anyway.
+    scale, width, height = _scale_filters(width, height, DECODE_MAX_WIDTH)
+    filters = scale or ["null"]
+    if width % 2 or height % 2:
+        frames = (frame.copy() for frame in _ffmpeg_raw(video_path, filters, "bgr24", (height, width, 3)))
+        return frames, False, 'ffmpeg_decode'
+    # The decoder's own pixel format: half the bytes of BGR through the pipe, the luma
+    # plane is already the grey image motion is scored on, and only the frames kept
+    # are ever converted.
+    return _ffmpeg_raw(video_path, filters, "yuv420p", (height * 3 // 2, width)), True, 'ffmpeg_decode'
+
+
+def to_bgr(frame, i420=False):
+    return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420) if i420 else frame
+
+
+def thumbnail(frame, i420=False):
+    """MOTION_SIZE grey version of a BGR (or I420) frame, for scoring motion."""
+    if i420:
+        return cv2.resize(frame[:frame.shape[0] * 2 // 3], MOTION_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(cv2.resize(frame, MOTION_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+
+def block_change(a, b):
+    """Largest mean absolute difference between two thumbnails over MOTION_BLOCK-square blocks."""
+    diff = cv2.absdiff(a, b)
+    blocks = cv2.resize(diff, (diff.shape[1] // MOTION_BLOCK, diff.shape[0] // MOTION_BLOCK),
+                        interpolation=cv2.INTER_AREA)
+    return float(blocks.max())
+
+
+def motion_indices(candidates, scores, budget):
+    """
+    Pick up to `budget` of the candidate frame indices (in order, with their motion
+    scores): a third of the budget, at least the first and last, spread evenly over
+    the clip, and the rest where the motion scores are highest. Those are first taken
+    at least MOTION_SPACING frames from any other pick, so one long movement (a head
+    turn) cannot absorb the whole budget. Returns sorted indices.
+    """
+    if len(candidates) <= budget:
+        return list(candidates)
+    coverage = min(budget, max(2, budget // 3))
+    picked = {candidates[int(round(p))] for p in np.linspace(0, len(candidates) - 1, coverage)}
+    by_motion = sorted(candidates, key=lambda i: -scores[i])
+    for spaced in (True, False):
+        for i in by_motion:
+            if len(picked) >= budget:
+                return sorted(picked)
+            if not spaced or all(abs(i - j) >= MOTION_SPACING for j in picked):
+                picked.add(i)
+    return sorted(picked)
+
+
+def motion_frames(frames, budget, max_buffered=None, i420=False):
+    """
+    Choose up to `budget` frames from an iterable of every frame, in one pass.
+
+    Each frame is scored by how much the picture changes going into or out of it
+    (block_change() between consecutive thumbnails), so both sides of a sudden change
+    score. Frames within DUPLICATE_THRESHOLD of the last distinct frame are dropped
+    on the spot. At most max_buffered (default 3 * budget) distinct frames are held;
+    past that the stillest one goes, except the first and the newest (whose score is
+    not final yet). Returns the chosen frames in order, as BGR (`frames` may be I420,
+    see all_frames()), or None if there were more than MAX_FRAMES.
+    """
+    max_buffered = max_buffered or 3 * budget
+    duplicate = DUPLICATE_THRESHOLD * (LUMA_RANGE if i420 else 1)
+    buffered = {}  # index -> frame
+    scores = {}
+    previous = kept = None
+    for i, frame in enumerate(frames):
+        if i >= MAX_FRAMES:
+            return None
+        thumb = thumbnail(frame, i420)
+        if previous is None:
+            change, distinct = 0.0, True
+        else:
+            change = block_change(previous, thumb)
+            distinct = block_change(kept, thumb) >= duplicate
+            if i - 1 in scores:
+                scores[i - 1] = max(scores[i - 1], change)
+        if distinct:
+            buffered[i] = frame
+            scores[i] = change
+            kept = thumb
+            if len(buffered) > max_buffered:
+                stillest = min((j for j in buffered if j not in (0, i)), key=scores.get)
+                del buffered[stillest], scores[stillest]
+        previous = thumb
+    return [to_bgr(buffered[i], i420) for i in motion_indices(list(buffered), scores, budget)]
+
+
+def uniform_indices(total_frames, num_frames):
+    num_frames = min(num_frames, total_frames)
+    return [int(i * total_frames / num_frames) for i in range(num_frames)]
+
+
+def read_frames(cap, indices):
+    """
+    Decode only the requested frame indices. Frames in between are skipped with
+    grab(), which demuxes and decodes but skips the colour conversion and copy
+    that read() pays for every frame. Returns frames in index order.
+    """
+    wanted = set(indices)
+    last = max(indices) if indices else -1
+    frames = []
+    idx = 0
+    while idx <= last:
+        if not cap.grab():
+            break
+        if idx in wanted:
+            ret, frame = cap.retrieve()
+            if ret:
+                frames.append(frame)
+        idx += 1
+    return frames
+
+
+def dump_frames(frames, frames_dir):
+    """Write frames as frame_01.jpg, frame_02.jpg, ... replacing any previous dump."""
+    os.makedirs(frames_dir, exist_ok=True)
+    for f in os.listdir(frames_dir):
+        os.remove(os.path.join(frames_dir, f))
+    for i, frame in enumerate(frames):
+        cv2.imwrite(os.path.join(frames_dir, f"frame_{i+1:02d}.jpg"), frame)
+
+
+def sample_frames(video_path, num_frames=FRAME_BUDGET, debug_dir=None, sampling=FRAME_SAMPLING):
+    """
+    Return up to num_frames frames, chosen by motion or uniformly spaced (`sampling`),
+    or None if the video cannot be decoded. When FACE_DEBUG_FRAMES=1 the frames are
+    also written to debug_dir.
+    """
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"sampling must be one of: {', '.join(SAMPLING_MODES)}")
+    if sampling == "motion":
+        all_decoded, i420, stage = all_frames(video_path)
+        if all_decoded is None:
+            return None
+        with metrics.stage(stage):
+            frames = motion_frames(all_decoded, num_frames, i420=i420)
+    else:
+        frames = decode_frames(video_path, lambda total_frames: uniform_indices(total_frames, num_frames))
+    if frames is None:
+        return None
+    if DEBUG_FRAMES and debug_dir:
+        dump_frames(frames, debug_dir)
+    return frames
@@ -0,0 +1,276 @@
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _squared_norms(vectors):
+    return np.einsum('ij,ij->i', vectors, vectors)
+
+
+def _exact_distances(queries, vectors, vector_norms=None):
+    """Euclidean distances between every query and every vector, shape (M, N)."""
+    if vector_norms is None:
+        vector_norms = _squared_norms(vectors)
+    sq = _squared_norms(queries)[:, np.newaxis] + vector_norms[np.newaxis, :] - 2.0 * queries @ vectors.T
+    return np.sqrt(np.maximum(sq, 0.0))
+
+
+def _top_k(distances, rows, k):
+    """Select the k smallest distances per query row, sorted ascending. Pads with inf / -1."""
+    m, n = distances.shape
+    out_dist = np.full((m, k), np.inf)
+    out_rows = np.full((m, k), -1, dtype=np.int64)
+    take = min(k, n)
+    if take == 0:
+        return out_dist, out_rows
+    part = np.argpartition(distances, take - 1, axis=1)[:, :take] if take < n else np.tile(np.arange(n), (m, 1))
+    part_dist = np.take_along_axis(distances, part, axis=1)
+    order = np.argsort(part_dist, axis=1)
+    out_dist[:, :take] = np.take_along_axis(part_dist, order, axis=1)
+    out_rows[:, :take] = np.take_along_axis(rows[part], order, axis=1)
+    return out_dist, out_rows
+
+
+class BruteForceIndex:
+    """
+    Exact linear scan over the gallery matrix. Default backend; right for galleries
+    up to a few tens of thousands of faces.
+    """
+
+    def __init__(self):
+        self._norms = np.empty(0)
+
+    def build(self, gallery, removed=()):
+        self._norms = _squared_norms(gallery) if len(gallery) else np.empty(0)
+        self._norms[np.asarray(removed, dtype=np.int64)] = np.inf
+
+    def add(self, row, encoding):
+        if row >= len(self._norms):
+            grown = np.empty(max(2 * len(self._norms), row + 1, 16))
+            grown[:len(self._norms)] = self._norms
+            self._norms = grown
+        self._norms[row] = float(encoding @ encoding)
+
+    def remove(self, row):
+        # An infinite norm puts the row at infinite distance from every query.
+        self._norms[row] = np.inf
+
+    def search(self, gallery, queries, k):
+        n = len(gallery)
+        distances = _exact_distances(queries, gallery, self._norms[:n])
+        return _top_k(distances, np.arange(n), k)
+
+
+class IVFIndex:
+    """
+    Inverted-file index: k-means centroids partition the gallery into `nlist` lists and a
+    query only scans the `nprobe` lists closest to it. Candidate distances are computed
+    exactly against the stored encodings, so any face returned carries its true distance
+    and the match threshold means the same thing as with brute force; only recall of the
+    best candidate is approximate.
+
+    Knobs:
+      - nlist: number of partitions (default ~4*sqrt(N) at training time)
+      - nprobe: partitions scanned per query; higher is slower with better recall
+      - min_train_size: below this many faces the index just scans everything
+      - retrain_growth: retrain centroids once the gallery grows by this factor
+
+    build() trains on the spot, unless centroids were trained before: then it only
+    assigns the gallery to them. Training that the gallery's growth calls for runs on
+    a background thread; searches keep using the current centroids (or the exact
+    scan) until it is done and the new partitions are swapped in.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, min_train_size=1024, retrain_growth=2.0, kmeans_iters=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_growth = retrain_growth
+        self.kmeans_iters = kmeans_iters
+        self.seed = seed
+        self.centroids = None
+        self._centroid_norms = None
+        self._lists = []
+        self._list_arrays = []
+        self._assignments = np.empty(0, dtype=np.int64)
+        self._trained_size = 0
+        self._gallery_norms = np.empty(0)
+        # Background training: the thread, and (centroids, assignments) once it is done
+        self._training = None
+        self._trained = None
+        self._training_lock = threading.Lock()
+
+    def build(self, gallery, removed=()):
+        """Index `gallery`, leaving out the `removed` rows."""
+        n = len(gallery)
+        with self._training_lock:
+            self._training = self._trained = None  # its assignments are for other rows
+        self._gallery_norms = _squared_norms(gallery) if n else np.empty(0)
+        self._gallery_norms[np.asarray(removed, dtype=np.int64)] = np.inf
+        if self.centroids is not None:
+            # The gallery was renumbered (compacted), not changed: keep the partitions.
+            self._install(self.centroids, np.empty(0, dtype=np.int64), gallery, self._trained_size)
+        elif n < self.min_train_size:
+            self._lists = []
+            self._list_arrays = []
+            self._assignments = np.full(n, -1, dtype=np.int64)
+        else:
+            self._install(*self._fit(gallery), gallery)
+
+    def _needs_training(self, n):
+        if self.centroids is None:
+            return n >= self.min_train_size
+        return n >= self.retrain_growth * self._trained_size
+
+    def _fit(self, gallery):
+        """Train centroids on `gallery`; returns them with every row's assignment."""
+        n = len(gallery)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(self.seed)
+        # Train on a sample; 32 points per centroid is plenty for 128-d face encodings.
+        sample = gallery[rng.choice(n, size=min(n, 32 * nlist), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            assign = self._assign(sample, centroids)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=nlist)
+            filled = counts > 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+            centroids[filled] = np.add.reduceat(sample[order], starts, axis=0) / counts[filled, np.newaxis]
+        return centroids, self._assign(gallery, centroids)
+
+    def _install(self, centroids, assignments, gallery, trained_size=None):
+        """
+        Partition `gallery` by `centroids`, given the assignments of its first rows
+        (training may have started before the rest were added). Removed rows, those
+        with an infinite norm, stay out of every list.
+        """
+        n = len(gallery)
+        nlist = len(centroids)
+        done = len(assignments)
+        if done < n:
+            assignments = np.concatenate((assignments, self._assign(gallery[done:], centroids)))
+        assignments[~np.isfinite(self._gallery_norms[:n])] = -1
+        self._assignments = assignments
+        self.centroids = centroids
+        self._centroid_norms = _squared_norms(centroids)
+        order = np.argsort(self._assignments, kind='stable')
+        bounds = np.searchsorted(self._assignments[order], np.arange(nlist + 1))
+        self._list_arrays = [order[bounds[i]:bounds[i + 1]] for i in range(nlist)]
+        self._lists = [None] * nlist
+        if trained_size is None:
+            self._trained_size = done
+            logger.info("IVFIndex: trained %d lists over %d faces.", nlist, done)
+        else:
+            self._trained_size = trained_size
+
+    def _train_in_background(self, gallery):
+        def train():
+            try:
+                trained = self._fit(gallery)
+            except Exception:
+                logger.exception("IVFIndex: training failed")
+                trained = None
+            with self._training_lock:
+                if self._training is thread:  # not superseded by build()
+                    self._trained = trained
+                    if trained is None:
+                        self._training = None
+
+        logger.info("IVFIndex: retraining over %d faces in the background.", len(gallery))
+        thread = self._training = threading.Thread(target=train, name="ivf-train", daemon=True)
+        thread.start()
+
+    def _maintain(self, gallery):
+        """Swap in finished background training, or start it if the gallery outgrew the centroids."""
+        with self._training_lock:
+            if self._trained is not None:
+                trained, self._trained, self._training = self._trained, None, None
+                self._install(*trained, gallery)
+            elif self._training is None and self._needs_training(len(gallery)):
+                self._train_in_background(gallery)
+
+    @staticmethod
+    def _assign(vectors, centroids, chunk=8192):
+        norms = _squared_norms(centroids)
+        out = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            block = vectors[start:start + chunk]
+            out[start:start + chunk] = np.argmin(norms[np.newaxis, :] - 2.0 * block @ centroids.T, axis=1)
+        return out
+
+    def _list(self, list_id):
+        # Lists are stored as arrays for scanning and only turned into Python lists
+        # while they are being modified by incremental adds.
+        if self._lists[list_id] is not None:
+            self._list_arrays[list_id] = np.fromiter(self._lists[list_id], dtype=np.int64)
+            self._lists[list_id] = None
+        return self._list_arrays[list_id]
+
+    def _mutable_list(self, list_id):
+        if self._lists[list_id] is None:
+            self._lists[list_id] = list(self._list_arrays[list_id])
+        return self._lists[list_id]
+
+    def add(self, row, encoding):
+        if row >= len(self._assignments):
+            grown = np.full(max(2 * len(self._assignments), row + 1, 16), -1, dtype=np.int64)
+            grown[:len(self._assignments)] = self._assignments
+            self._assignments = grown
+            norms = np.empty(len(grown))
+            norms[:len(self._gallery_norms)] = self._gallery_norms
+            self._gallery_norms = norms
+        self._gallery_norms[row] = float(encoding @ encoding)
+
+        if self.centroids is None:
+            return
+        old = self._assignments[row]
+        new = int(np.argmin(self._centroid_norms - 2.0 * self.centroids @ encoding))
+        if old >= 0 and old != new:
+            self._mutable_list(old).remove(row)
+        if old != new:
+            self._mutable_list(new).append(row)
+        self._assignments[row] = new
+
+    def remove(self, row):
+        self._gallery_norms[row] = np.inf
+        if self.centroids is not None and self._assignments[row] >= 0:
+            self._mutable_list(int(self._assignments[row])).remove(row)
+            self._assignments[row] = -1
+
+    def search(self, gallery, queries, k):
+        n = len(gallery)
+        self._maintain(gallery)
+        if self.centroids is None:
+            distances = _exact_distances(queries, gallery, self._gallery_norms[:n])
+            return _top_k(distances, np.arange(n), k)
+
+        nprobe = min(self.nprobe, len(self.centroids))
+        centroid_scores = self._centroid_norms[np.newaxis, :] - 2.0 * queries @ self.centroids.T
+        probes = np.argpartition(centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+        out_dist = np.full((len(queries), k), np.inf)
+        out_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, query in enumerate(queries):
+            rows = np.concatenate([self._list(int(l)) for l in probes[q]])
+            if rows.size == 0:
+                continue
+            distances = _exact_distances(query[np.newaxis, :], gallery[rows], self._gallery_norms[rows])
+            top_dist, top_rows = _top_k(distances, rows, k)
+            out_dist[q], out_rows[q] = top_dist[0], top_rows[0]
+        return out_dist, out_rows
+
+
+INDEX_BACKENDS = {
+    'brute': BruteForceIndex,
+    'ivf': IVFIndex,
+}
+
+
+def create_index(backend='brute', **params):
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"Unknown gallery index backend '{backend}'. Choose from: {', '.join(INDEX_BACKENDS)}")
+    return INDEX_BACKENDS[backend](**params)
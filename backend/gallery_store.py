@@ -0,0 +1,393 @@
+"""
+SQLite store for the face gallery (known_faces/gallery.db).
+
+One row per enrolled face holds its id, name, 128-d encoding, the JPEG face crop
+and created/updated timestamps. Every add, rename and removal is a single
+transaction, so concurrent enrollments from several worker processes never lose
+each other's writes and a crash never leaves a half-written gallery.
+
+Each change is also recorded in gallery_log. A process holding the gallery in
+memory remembers the last log entry it has seen and, on refresh, reads back only
+the faces changed since, so picking up another worker's enrollment costs one
+indexed query instead of a reload. Processes that search the gallery do not even
+do that: after every change the store also updates the memory-mapped copy they all
+share (see shared_gallery.py).
+
+Galleries from before the store (loose referenceN.jpg files, face_metadata.json
+and the face_encodings.* cache) are imported once, the first time the store is
+opened next to them, or explicitly with:
+    python gallery_store.py migrate static/known_faces
+The legacy files are left in place but no longer read.
+"""
+import os
+import re
+import json
+import logging
+import sqlite3
+import argparse
+import contextlib
+import threading
+from datetime import datetime, timezone
+import numpy as np
+import logging_config
+from shared_gallery import SharedGallery
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+GALLERY_DB = 'gallery.db'
+ENCODING_SIZE = 128
+ENCODING_DTYPE = np.float64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS faces (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    face_id TEXT UNIQUE,
+    name TEXT NOT NULL,
+    encoding BLOB NOT NULL,
+    thumbnail BLOB,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS faces_name ON faces (name);
+CREATE TABLE IF NOT EXISTS gallery_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    face_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS gallery_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+@contextlib.contextmanager
+def interprocess_lock(path):
+    """Exclusive lock on `path`, shared by every process opening the same gallery."""
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def _encoding_blob(encoding):
+    return np.asarray(encoding, dtype=ENCODING_DTYPE).reshape(ENCODING_SIZE).tobytes()
+
+
+def _encoding_array(blob):
+    return np.frombuffer(blob, dtype=ENCODING_DTYPE).copy()
+
+
+class GalleryStore:
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.lock_file = os.path.splitext(path)[0] + '.lock'
+        self.directory = os.path.dirname(path) or '.'
+        # Writable mapping of the shared segment, face_id -> row for its live rows, and
+        # how many of its rows have been read into that map
+        self._segment = None
+        self._segment_rows = {}
+        self._segment_scanned = 0
+        # Read-only mapping for size(), opened on first use
+        self._reader = None
+        # Autocommit mode; every method below opens its own explicit transaction.
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self, write=False):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _log(conn, face_ids):
+        conn.executemany("INSERT INTO gallery_log (face_id) VALUES (?)", [(face_id,) for face_id in face_ids])
+
+    @staticmethod
+    def _version(conn):
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM gallery_log").fetchone()[0]
+
+    def version(self):
+        """Sequence number of the latest change; grows with every add, rename or removal."""
+        with self._lock:
+            return self._version(self._conn)
+
+    def faces(self):
+        """Every face as (face_id, name, encoding), in enrollment order, and the store version."""
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT face_id, name, encoding FROM faces ORDER BY id").fetchall()
+            version = self._version(conn)
+        return [(face_id, name, _encoding_array(blob)) for face_id, name, blob in rows], version
+
+    def changes(self, since):
+        """
+        Faces changed after version `since`. Returns ([(face_id, name, encoding)] added or
+        renamed, [face_id] removed, current version).
+        """
+        with self._transaction() as conn:
+            version = self._version(conn)
+            if version == since:
+                return [], [], version
+            changed = {face_id for (face_id,) in conn.execute(
+                "SELECT DISTINCT face_id FROM gallery_log WHERE seq > ?", (since,))}
+            rows = conn.execute(
+                "SELECT face_id, name, encoding FROM faces "
+                "WHERE face_id IN (SELECT face_id FROM gallery_log WHERE seq > ?) ORDER BY id", (since,)).fetchall()
+        updated = [(face_id, name, _encoding_array(blob)) for face_id, name, blob in rows]
+        removed = changed - {face_id for face_id, _, _ in updated}
+        return updated, sorted(removed), version
+
+    def add(self, faces):
+        """Add (name, encoding, thumbnail) tuples in one transaction. Returns the new face ids in order."""
+        now = _now()
+        face_ids = []
+        with self._transaction(write=True) as conn:
+            for name, encoding, thumbnail in faces:
+                row = conn.execute(
+                    "INSERT INTO faces (name, encoding, thumbnail, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (name, _encoding_blob(encoding), thumbnail, now, now)).lastrowid
+                face_id = f"reference{row}"
+                conn.execute("UPDATE faces SET face_id = ? WHERE id = ?", (face_id, row))
+                face_ids.append(face_id)
+            self._log(conn, face_ids)
+        self.sync_segment()
+        return face_ids
+
+    def rename(self, face_id, name):
+        """Returns False if there is no such face."""
+        with self._transaction(write=True) as conn:
+            if conn.execute("UPDATE faces SET name = ?, updated_at = ? WHERE face_id = ?",
+                            (name, _now(), face_id)).rowcount == 0:
+                return False
+            self._log(conn, [face_id])
+        self.sync_segment()
+        return True
+
+    def remove(self, face_id):
+        """Returns False if there is no such face."""
+        with self._transaction(write=True) as conn:
+            if conn.execute("DELETE FROM faces WHERE face_id = ?", (face_id,)).rowcount == 0:
+                return False
+            self._log(conn, [face_id])
+        self.sync_segment()
+        return True
+
+    def sync_segment(self):
+        """
+        Bring the shared segment up to date with the database, building it if there is
+        none. Changes are applied in place: appended rows, new name references and
+        tombstones for removals. A segment out of room grows into a new generation
+        with the same rows; one that is mostly tombstones is rebuilt compacted.
+        """
+        with self._lock, interprocess_lock(self.lock_file):
+            segment = self._segment
+            if segment is None or not segment.current:
+                segment = self._segment = SharedGallery.open_latest(self.directory, writable=True)
+                self._segment_rows, self._segment_scanned = {}, 0
+            if segment is None or segment.version > self.version():
+                return self._rebuild_segment()
+            updated, removed, version = self.changes(segment.version)
+            if version == segment.version:
+                return
+            rows = self._segment_face_rows()
+            for face_id in removed:
+                row = rows.pop(face_id, None)
+                if row is not None:
+                    segment.remove(row)
+            if segment.removed > segment.count // 2:
+                return self._rebuild_segment()
+            renamed = [(rows[face_id], name) for face_id, name, _ in updated if face_id in rows]
+            added = [face for face in updated if face[0] not in rows]
+            while not (all(segment.rename(row, name) for row, name in renamed) and segment.append(added, version)):
+                segment = self._segment = segment.grow(self.directory)
+            segment.publish(version)
+
+    def _segment_face_rows(self):
+        # Rows are only ever appended to a layout, so only new ones need reading.
+        for row in range(self._segment_scanned, self._segment.count):
+            face_id = self._segment.face_id(row)
+            if face_id:
+                self._segment_rows[face_id] = row
+        self._segment_scanned = self._segment.count
+        return self._segment_rows
+
+    def _rebuild_segment(self):
+        faces, version = self.faces()
+        self._segment = SharedGallery.build(self.directory, faces, version)
+        self._segment_rows, self._segment_scanned = {}, 0
+
+    def list(self, name=None):
+        """Face records without encodings or images, optionally only those enrolled under `name`."""
+        query = "SELECT face_id, name, created_at, updated_at FROM faces"
+        args = ()
+        if name is not None:
+            query += " WHERE name = ?"
+            args = (name,)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY id", args).fetchall()
+        return [{"face_id": face_id, "name": name, "created_at": created, "updated_at": updated}
+                for face_id, name, created, updated in rows]
+
+    def thumbnail(self, face_id):
+        """The stored JPEG face crop, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT thumbnail FROM faces WHERE face_id = ?", (face_id,)).fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+    def size(self):
+        """
+        Number of faces as of the shared segment's last update: a header read instead of a
+        query, so it is cheap enough to call from the event loop. Counts the database until
+        a segment exists.
+        """
+        reader = self._reader
+        if reader is None or not reader.current:
+            reader = self._reader = SharedGallery.open_latest(self.directory)
+        return reader.count - reader.removed if reader is not None else self.count()
+
+    def migrated(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM gallery_meta WHERE key = 'legacy_migrated'").fetchone() is not None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._segment = self._reader = None
+
+
+def _legacy_encodings(reference_dir):
+    """{filename: encoding} from the old face_encodings.bin/.idx cache, for images that have not changed since."""
+    data_file = os.path.join(reference_dir, 'face_encodings.bin')
+    index_file = os.path.join(reference_dir, 'face_encodings.idx')
+    try:
+        with open(index_file, 'r') as f:
+            index = [json.loads(line) for line in f if line.strip()]
+        rows = np.fromfile(data_file, dtype=ENCODING_DTYPE)
+    except (OSError, ValueError):
+        return {}
+    rows = rows[:rows.size - rows.size % ENCODING_SIZE].reshape(-1, ENCODING_SIZE)
+    cached = {}
+    for entry, row in zip(index, rows):
+        path = os.path.join(reference_dir, entry['file'])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # Later rows supersede earlier ones, as in the old cache.
+        if entry['key'] == f"{stat.st_mtime_ns}:{stat.st_size}":
+            cached[entry['file']] = row.copy()
+        else:
+            cached.pop(entry['file'], None)
+    return cached
+
+
+def migrate_legacy(store, reference_dir, encode):
+    """
+    Import the *.jpg gallery in reference_dir into `store`, once. Names come from
+    face_metadata.json, encodings from the old cache where it is still valid and
+    otherwise from encode(img_path). referenceN.jpg keeps the face id referenceN.
+    Returns the number of faces imported.
+    """
+    with interprocess_lock(store.lock_file):
+        if store.migrated():
+            return 0
+        metadata_file = os.path.join(reference_dir, 'face_metadata.json')
+        metadata = {}
+        if os.path.exists(metadata_file):
+            with open(metadata_file, 'r') as f:
+                metadata = json.load(f)
+        cached = _legacy_encodings(reference_dir)
+
+        faces = []
+        for filename in sorted(f for f in os.listdir(reference_dir) if f.endswith('.jpg')):
+            img_path = os.path.join(reference_dir, filename)
+            try:
+                encoding = cached.get(filename)
+                if encoding is None:
+                    encoding = encode(img_path)
+                with open(img_path, 'rb') as f:
+                    thumbnail = f.read()
+            except Exception as e:
+                logger.error("Error importing %s: %s", filename, e)
+                continue
+            match = re.fullmatch(r'reference(\d*)\.jpg', filename)
+            row = int(match.group(1) or 0) if match else None
+            faces.append((row, os.path.splitext(filename)[0], metadata.get(filename, 'Unknown'), encoding, thumbnail))
+
+        now = _now()
+        with store._transaction(write=True) as conn:
+            # referenceN.jpg goes in as row N first so faces added later, named after their
+            # row, can never reuse an imported id.
+            taken = set()
+            for row, face_id, name, encoding, thumbnail in sorted(faces, key=lambda f: f[0] is None):
+                if row in taken:
+                    row = None
+                row = conn.execute(
+                    "INSERT INTO faces (id, face_id, name, encoding, thumbnail, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (row, face_id, name, _encoding_blob(encoding), thumbnail, now, now)).lastrowid
+                taken.add(row)
+            store._log(conn, [face_id for _, face_id, _, _, _ in faces])
+            conn.execute("INSERT INTO gallery_meta (key, value) VALUES ('legacy_migrated', ?)", (now,))
+        logger.info("GalleryStore: imported %d faces from %s", len(faces), reference_dir)
+        return len(faces)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the SQLite face gallery.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="import a legacy known_faces directory (JPEGs + face_metadata.json)")
+    migrate.add_argument("reference_dir", nargs="?", default="static/known_faces")
+    listing = sub.add_parser("list", help="list enrolled faces")
+    listing.add_argument("reference_dir", nargs="?", default="static/known_faces")
+    args = parser.parse_args()
+    logging_config.setup()
+
+    store = GalleryStore(os.path.join(args.reference_dir, GALLERY_DB))
+    if args.command == "migrate":
+        if store.migrated():
+            print("Gallery already migrated.")
+            return
+        # Opening the gallery imports it.
+        from face_recognizer import FaceRecognizer
+        FaceRecognizer(args.reference_dir)
+    else:
+        for face in store.list():
+            print(f"{face['face_id']}\t{face['name']}\t{face['created_at']}")
+
+
+if __name__ == "__main__":
+    main()
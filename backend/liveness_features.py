@@ -0,0 +1,176 @@
+"""
+Liveness features computed from MediaPipe landmarks, shared by every video endpoint.
+
+MediaPipe is run once per sampled frame; the landmarks of the whole clip are then
+stacked into one (F, 478, 3) array and every metric is computed for all frames at
+once with array operations. The result is a per-frame feature table (a numpy
+structured array) with one row per frame in which a face was found:
+
+    frame   index of the frame in the sampled clip
+    ear     mean eye aspect ratio of both eyes (low when the eyes are closed)
+    mar     mouth aspect ratio (high when the mouth is open)
+    smile   mouth-corner height difference relative to lip opening
+    nose_x  nose tip position in pixels
+    nose_y
+
+Adding a metric means adding a column here, not another copy of the loop.
+"""
+import cv2
+import numpy as np
+import metrics
+
+LEFT_EYE_IDX = [33, 160, 158, 133, 153, 144]
+RIGHT_EYE_IDX = [362, 385, 387, 263, 373, 380]
+MOUTH_IDX = [61, 291, 81, 178, 13, 14, 17, 402, 318, 324, 308, 415]
+NOSE_IDX = 1
+FINGER_TIPS = [4, 8, 12, 16, 20]
+FINGER_PIPS = [2, 6, 10, 14, 18]
+
+FACE_FEATURES = np.dtype([
+    ('frame', np.int32),
+    ('ear', np.float64),
+    ('mar', np.float64),
+    ('smile', np.float64),
+    ('nose_x', np.float64),
+    ('nose_y', np.float64),
+])
+
+
+def landmarks_to_array(landmark_list):
+    """Convert a MediaPipe NormalizedLandmarkList into an (L, 3) array of x, y, z."""
+    return np.array([(p.x, p.y, p.z) for p in landmark_list.landmark], dtype=np.float64)
+
+
+def _aspect_ratio(points, a, b, c):
+    """(|a0-a1| + |b0-b1|) / (2|c0-c1|) over (F, K, 2) points, for all frames at once."""
+    def dist(pair):
+        return np.linalg.norm(points[:, pair[0]] - points[:, pair[1]], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (dist(a) + dist(b)) / (2.0 * dist(c))
+
+
+def face_feature_table(landmarks, frame_sizes, frame_indices):
+    """
+    landmarks: (F, L, 3) normalized landmarks; frame_sizes: (F, 2) as (height, width).
+    Returns a FACE_FEATURES structured array with one row per frame.
+    """
+    table = np.zeros(len(frame_indices), dtype=FACE_FEATURES)
+    table['frame'] = frame_indices
+    if not len(frame_indices):
+        return table
+
+    h = frame_sizes[:, 0, np.newaxis].astype(np.float64)
+    w = frame_sizes[:, 1, np.newaxis].astype(np.float64)
+    # Eye and mouth ratios work on whole-pixel coordinates, as they always have.
+    pixels = np.stack([(landmarks[:, :, 0] * w).astype(np.int64),
+                       (landmarks[:, :, 1] * h).astype(np.int64)], axis=2).astype(np.float64)
+
+    eye_pairs = ((1, 5), (2, 4), (0, 3))
+    left_ear = _aspect_ratio(pixels[:, LEFT_EYE_IDX], *eye_pairs)
+    right_ear = _aspect_ratio(pixels[:, RIGHT_EYE_IDX], *eye_pairs)
+    table['ear'] = (left_ear + right_ear) / 2.0
+    table['mar'] = _aspect_ratio(pixels[:, MOUTH_IDX], (2, 10), (4, 8), (0, 6))
+    table['smile'] = np.abs(landmarks[:, 61, 1] - landmarks[:, 291, 1]) / \
+        (np.abs(landmarks[:, 13, 1] - landmarks[:, 14, 1]) + 1e-6)
+    table['nose_x'] = landmarks[:, NOSE_IDX, 0] * w[:, 0]
+    table['nose_y'] = landmarks[:, NOSE_IDX, 1] * h[:, 0]
+    return table
+
+
+def face_boxes(landmarks, frame_sizes, padding=0.0):
+    """
+    Face bounding boxes from (F, L, 3) normalized landmarks, in face_recognition's
+    (top, right, bottom, left) pixel order, grown by `padding` times the box size
+    on each side and clipped to the frame. Returns an (F, 4) int array.
+    """
+    h = frame_sizes[:, 0].astype(np.float64)
+    w = frame_sizes[:, 1].astype(np.float64)
+    left, right = landmarks[:, :, 0].min(axis=1) * w, landmarks[:, :, 0].max(axis=1) * w
+    top, bottom = landmarks[:, :, 1].min(axis=1) * h, landmarks[:, :, 1].max(axis=1) * h
+    pad_x, pad_y = (right - left) * padding, (bottom - top) * padding
+    boxes = np.stack([np.clip(top - pad_y, 0, h - 1), np.clip(right + pad_x, 0, w - 1),
+                      np.clip(bottom + pad_y, 0, h - 1), np.clip(left - pad_x, 0, w - 1)], axis=1)
+    return boxes.astype(np.int64).reshape(-1, 4)
+
+
+def face_locations(table, face_landmarks, frames, padding=0.0):
+    """
+    Per-frame face locations for FaceRecognizer.recognize_batch: a list aligned
+    with `frames` holding [box] where FaceMesh found a face and None elsewhere
+    (so recognition falls back to its own detector for those frames).
+    """
+    locations = [None] * len(frames)
+    sizes = np.array([frames[i].shape[:2] for i in table['frame']]).reshape(-1, 2)
+    for i, box in zip(table['frame'], face_boxes(face_landmarks, sizes, padding)):
+        locations[i] = [tuple(int(v) for v in box)]
+    return locations
+
+
+def fingers_up(hand_landmarks, confidence):
+    """
+    hand_landmarks: (H, 21, 3) normalized landmarks. Returns an (H, 5) bool array,
+    thumb first, True where the finger tip is above its PIP joint by `confidence`.
+    """
+    tips = hand_landmarks[:, FINGER_TIPS, 1]
+    pips = hand_landmarks[:, FINGER_PIPS, 1]
+    return tips < pips - confidence
+
+
+def frame_landmarks(image, face_mesh, roi=None, margin=0.5):
+    """
+    FaceMesh landmarks of one BGR frame as an (L, 3) array in whole-frame normalized
+    coordinates, or None. Given the face box of the previous frame as `roi`, the
+    mesh runs on a crop around it first, where the face fills more of the model's
+    input, and falls back to the whole frame if the face has left it.
+    """
+    h, w = image.shape[:2]
+    if roi is not None:
+        top, right, bottom, left = roi
+        margin_y, margin_x = int((bottom - top) * margin), int((right - left) * margin)
+        y0, y1 = max(top - margin_y, 0), min(bottom + margin_y, h)
+        x0, x1 = max(left - margin_x, 0), min(right + margin_x, w)
+        if y1 > y0 and x1 > x0:
+            with metrics.stage('facemesh'):
+                results = face_mesh.process(cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2RGB))
+            if results.multi_face_landmarks:
+                points = landmarks_to_array(results.multi_face_landmarks[0])
+                points[:, 0] = (points[:, 0] * (x1 - x0) + x0) / w
+                points[:, 1] = (points[:, 1] * (y1 - y0) + y0) / h
+                return points
+    with metrics.stage('facemesh'):
+        results = face_mesh.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    if results.multi_face_landmarks:
+        return landmarks_to_array(results.multi_face_landmarks[0])
+    return None
+
+
+def extract_features(frames, face_mesh, hands=None):
+    """
+    Run FaceMesh (and Hands, if given) over BGR frames.
+
+    Returns (face_table, hand_landmarks, face_landmarks): the FACE_FEATURES table,
+    an (H, 21, 3) array of every hand found in any frame (None without `hands`),
+    and the stacked (F, L, 3) face landmarks matching the table rows.
+    """
+    face_rows, face_sizes, face_landmarks = [], [], []
+    hand_landmarks = []
+    for i, image in enumerate(frames):
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        with metrics.stage('facemesh'):
+            results = face_mesh.process(rgb)
+        if results.multi_face_landmarks:
+            face_rows.append(i)
+            face_sizes.append(image.shape[:2])
+            face_landmarks.append(landmarks_to_array(results.multi_face_landmarks[0]))
+        if hands is not None:
+            with metrics.stage('hands'):
+                hand_results = hands.process(rgb)
+            if hand_results.multi_hand_landmarks:
+                hand_landmarks.extend(landmarks_to_array(h) for h in hand_results.multi_hand_landmarks)
+
+    face_landmarks = np.stack(face_landmarks) if face_landmarks else np.empty((0, 478, 3))
+    table = face_feature_table(face_landmarks, np.array(face_sizes).reshape(-1, 2), face_rows)
+    if hands is None:
+        return table, None, face_landmarks
+    hand_landmarks = np.stack(hand_landmarks) if hand_landmarks else np.empty((0, 21, 3))
+    return table, hand_landmarks, face_landmarks
@@ -0,0 +1,102 @@
+"""
+Logging for the server and its worker processes.
+
+A log call only puts the record on a queue (QueueHandler). A QueueListener thread
+in the server process formats and writes it, so neither request handling nor the
+model workers ever wait on console or file I/O. ExecutionLayer hands the same
+queue to every worker process, so their records come out through that listener
+too.
+
+Every record carries the ID of the request it was logged for: the X-Request-ID
+header if the client sent one, otherwise a generated one. That includes records
+logged inside a worker while it runs the request's job.
+
+Per-face and per-frame detail is logged at DEBUG, and even then only for a
+FACE_LOG_SAMPLE fraction of calls (see sampled()), so at the default INFO level
+the recognition hot path logs nothing.
+
+    FACE_LOG_LEVEL   DEBUG, INFO (default), WARNING, ...
+    FACE_LOG_SAMPLE  share of per-face/per-frame DEBUG lines kept (default 0.01)
+    FACE_LOG_FILE    also write to this file
+"""
+import os
+import atexit
+import random
+import logging
+import contextvars
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s"
+LOG_LEVEL = os.environ.get("FACE_LOG_LEVEL", "INFO").upper()
+SAMPLE_RATE = float(os.environ.get("FACE_LOG_SAMPLE", "0.01"))
+LOG_FILE = os.environ.get("FACE_LOG_FILE") or None
+
+request_id = contextvars.ContextVar("request_id", default="-")
+
+_queue = None
+_listener = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the current request ID; runs in the logging process/thread."""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id.get()
+        return True
+
+
+def _install(queue, level):
+    handler = QueueHandler(queue)
+    handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+
+def setup(level=LOG_LEVEL):
+    """Route this process's logging through a queue drained by a background thread (idempotent)."""
+    global _queue, _listener
+    if _queue is not None:
+        return
+    # A multiprocessing queue, so spawned workers can log into it as well.
+    _queue = multiprocessing.get_context("spawn").Queue(-1)
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    _listener = QueueListener(_queue, *handlers)
+    _listener.start()
+    _install(_queue, level)
+    atexit.register(shutdown)
+
+
+def worker_args():
+    """(queue, level) for setup_worker() in a child process, or None if setup() was not called."""
+    if _queue is None:
+        return None
+    return _queue, logging.getLogger().level
+
+
+def setup_worker(queue, level):
+    """In a worker process: send every record to the server's listener."""
+    _install(queue, level)
+
+
+def shutdown():
+    """Flush the queue and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def sampled(logger, level=logging.DEBUG):
+    """
+    Guard for per-face/per-frame detail: True when `logger` is enabled for `level`
+    and this call falls in the FACE_LOG_SAMPLE fraction.
+    """
+    return logger.isEnabledFor(level) and random.random() < SAMPLE_RATE
@@ -1,15 +1,26 @@
-from fastapi import FastAPI, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, UploadFile, File, Form, WebSocket
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from face_recognizer import FaceRecognizer
+from pydantic import BaseModel, ValidationError
+from executor import ExecutionLayer, ServerBusy
+from workspace import WorkspaceManager, WorkspaceQuotaExceeded, UploadTooLarge
+from face_recognizer import RESPONSE_MODES, base64_image_bytes
+from gallery_store import GalleryStore, GALLERY_DB
+import pipelines
+import unlock_stream
+import bulk_enroll
+import metrics
+import result_cache
+import logging_config
+import logging
+import uuid
 import os
-import shutil
-import cv2
-import subprocess
-import mediapipe as mp
-import numpy as np
+import time
+
+logging_config.setup()
+logger = logging.getLogger(__name__)
 
 
 app = FastAPI()
@@ -32,64 +43,254 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Initialize face recognizer with the known faces directory
 known_faces_dir = "static/known_faces"
-print(f"DEBUG: In main.py, known_faces_dir is: {known_faces_dir}")
-recognizer = FaceRecognizer(known_faces_dir)
+logger.debug("known_faces_dir is: %s", known_faces_dir)
+# Gallery index: "brute" (exact, default) or "ivf" (approximate, for very large galleries)
+index_backend = os.environ.get("FACE_INDEX_BACKEND", "brute")
+index_params = {"nprobe": int(os.environ.get("FACE_INDEX_NPROBE", "8"))} if index_backend == "ivf" else {}
+
+# Model work runs in worker processes (FACE_EXECUTOR=process, the default) or threads
+# (FACE_EXECUTOR=thread); each worker loads its own FaceRecognizer via init_worker, in the
+# background once started, while the server already answers /healthz and /readyz.
+execution = ExecutionLayer.from_env(
+    initializer=pipelines.init_worker,
+    initargs=(known_faces_dir, index_backend, index_params),
+)
+
+# Listing, renaming and removing faces only touch the database, so they run here on the
+# io threads; the workers pick the changes up from the gallery log on their next request.
+gallery = GalleryStore(os.path.join(known_faces_dir, GALLERY_DB))
+metrics.gauge('face_gallery_size', 'Enrolled faces.', gallery.size)
+
+# Repeated uploads of the same image or clip (client retries) are answered from here
+# until the gallery changes; see result_cache.py.
+results = result_cache.ResultCache()
+
+@app.on_event("startup")
+async def start_workers():
+    execution.start()
+
+@app.on_event("shutdown")
+async def stop_workers():
+    execution.shutdown()
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Label by route template (/faces/{face_id}), not the raw path, to keep the series bounded.
+    # Mounts (/static) set no route, only their root path.
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", None) or request.scope.get("root_path") or "unmatched"
+    metrics.record_request(endpoint, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+def request_id_from(headers):
+    """The client's X-Request-ID, or a fresh one."""
+    return headers.get("x-request-id") or uuid.uuid4().hex[:12]
+
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    # Every log line for this request, including those from the model workers, carries the ID.
+    request_id = request_id_from(request.headers)
+    logging_config.request_id.set(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.exception_handler(ServerBusy)
+async def server_busy_handler(request: Request, exc: ServerBusy):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+        content={"error": "Server busy", "detail": str(exc)}
+    )
+
+@app.exception_handler(WorkspaceQuotaExceeded)
+async def workspace_quota_handler(request: Request, exc: WorkspaceQuotaExceeded):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+        content={"error": "Server busy", "detail": str(exc)}
+    )
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request: Request, exc: UploadTooLarge):
+    return JSONResponse(status_code=413, content={"error": str(exc)})
+
+# Each video request gets its own scratch directory, removed when the request ends,
+# so concurrent uploads never overwrite each other's files.
+workspaces = WorkspaceManager.from_env()
 
 class ImageData(BaseModel):
     image: str
     name: str = None  # Optional name for adding new faces
 
+class FaceName(BaseModel):
+    name: str
+
+# Room for the multipart boundaries and the "name" field around the image itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+def json_body_limit(max_upload_bytes):
+    """A JSON body carries the image as base64, 4 bytes of text for every 3 of image."""
+    return -(-max_upload_bytes // 3) * 4 + MULTIPART_OVERHEAD_BYTES
+
+def limit_body(request: Request, limit):
+    """
+    The same request, but reading its body raises UploadTooLarge as soon as more than
+    `limit` bytes have arrived, however the client sends it (Content-Length or chunked).
+    """
+    if int(request.headers.get("content-length") or 0) > limit:
+        raise UploadTooLarge(workspaces.max_upload_bytes)
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise UploadTooLarge(workspaces.max_upload_bytes)
+        return message
+
+    return Request(request.scope, receive)
+
+async def read_image_upload(request: Request):
+    """
+    Read the image (and optional name) for /unlock and /add_face. Returns (image, name),
+    where image is the encoded image bytes, whichever way they were sent:
+    - application/json: {"image": "data:image/jpeg;base64,...", "name": ...} (original API)
+    - multipart/form-data: an "image" file field and an optional "name" field
+    - image/*: the encoded image as the whole body, name in ?name=
+    Bodies are read incrementally and cut off at workspaces.max_upload_bytes (plus the
+    base64 or multipart overhead). Raises ValueError for a malformed upload.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await limit_body(request, workspaces.max_upload_bytes + MULTIPART_OVERHEAD_BYTES).form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise ValueError("Multipart uploads need an 'image' file field")
+        if upload.size is not None and upload.size > workspaces.max_upload_bytes:
+            raise UploadTooLarge(workspaces.max_upload_bytes)
+        image = await upload.read()
+        name = form.get("name") or request.query_params.get("name")
+    elif content_type.startswith("image/"):
+        image = await limit_body(request, workspaces.max_upload_bytes).body()
+        name = request.query_params.get("name")
+    else:
+        body = await limit_body(request, json_body_limit(workspaces.max_upload_bytes)).body()
+        try:
+            data = ImageData.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        image, name = base64_image_bytes(data.image), data.name
+    if len(image) > workspaces.max_upload_bytes:
+        raise UploadTooLarge(workspaces.max_upload_bytes)
+    return image, name
+
+# ?response= picks what recognition endpoints return as processed_image:
+# full (default), thumbnail or none (box/identity/score only)
+def invalid_response_mode():
+    return JSONResponse(
+        status_code=400,
+        content={"error": f"response must be one of: {', '.join(RESPONSE_MODES)}"}
+    )
+
+async def run_model_cached(digest, params, fn, *args, workspace=None):
+    """
+    execution.run_model(fn, *args) as a JSON response, served from the result cache
+    when an upload with this digest was already run through fn with the same params.
+    `workspace` holds the uploaded file the args point to.
+    """
+    if not results.enabled:
+        return JSONResponse(content=await execution.run_model(fn, *args))
+
+    async def run():
+        try:
+            return JSONResponse(content=await execution.run_model(fn, *args)).body
+        finally:
+            if workspace is not None:
+                workspace.release()
+
+    def compute():
+        # The job keeps running for the requests that joined it if this one is cancelled.
+        if workspace is not None:
+            workspace.hold()
+        return run()
+
+    version = await execution.run_io(gallery.version)
+    body = await results.get_or_compute((fn.__name__, digest) + params, version, compute)
+    return Response(content=body, media_type="application/json")
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus scrape target: per-endpoint request latency, per-stage model timings,
+    # pool occupancy/queue depth and gallery size.
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the server process is up and its event loop answers. Says nothing about the models.
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: every model worker has loaded the gallery and its models and run its warmup.
+    # Until then model endpoints answer 503, so load balancers should route on this.
+    status = {"workers": execution.model.workers, "warm_workers": execution.warm_workers}
+    if execution.broken:
+        return JSONResponse(status_code=503, content={"error": "Model workers have stopped", **status})
+    if not execution.ready:
+        return JSONResponse(status_code=503, content={"error": "Models are still loading", **status})
+    return {"status": "ready", **status}
+
 @app.get("/", response_class=HTMLResponse)
 async def serve_frontend():
     with open("backend/static/index.html", "r", encoding="utf-8") as f:
         return f.read()
 
 @app.post("/unlock")
-async def unlock_face(data: ImageData):
+async def unlock_face(request: Request, response: str = "full"):
+    if response not in RESPONSE_MODES:
+        return invalid_response_mode()
     try:
-        match_status, score_raw, processed_image, name = recognizer.recognize(data.image)
-        score = float(score_raw)
-
-        # Only succeed if a face is detected and matched
-        if match_status == "No Match" or name == "Unknown" or score <= 0.5:
-            return JSONResponse(content={
-                "success": False,
-                "identity": name,
-                "score": score,
-                "processed_image": processed_image,
-                "error": "No face detected or face not recognized. Please try again or add your face."
-            })
-
-        return JSONResponse(content={
-            "success": True,
-            "identity": name,
-            "score": score,
-            "processed_image": processed_image
-        })
+        image, _ = await read_image_upload(request)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    try:
+        digest = await execution.run_io(result_cache.digest, image)
+        return await run_model_cached(digest, (response,), pipelines.unlock_image, image, response)
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
     except Exception as e:
-        import traceback
-        print(f"ERROR: Exception in /unlock endpoint: {e}")
-        traceback.print_exc()
+        logger.exception("Exception in /unlock endpoint")
         return JSONResponse(
             status_code=500,
             content={"error": "Internal Server Error", "detail": str(e)}
         )
 
 @app.post("/add_face")
-async def add_face(data: ImageData):
-    if not data.name:
+async def add_face(request: Request):
+    try:
+        image, name = await read_image_upload(request)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if not name:
         return JSONResponse(
             status_code=400,
             content={"error": "Name is required for adding a new face"}
         )
     
     try:
-        face_id = recognizer.add_reference_face(data.image, data.name)
+        face_id = await execution.run_model(pipelines.add_face, image, name)
         return JSONResponse(content={
             "success": True,
             "message": f"Face added successfully with ID: {face_id}",
             "face_id": face_id
         })
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
     except Exception as e:
         return JSONResponse(
             status_code=400,
@@ -99,152 +300,12 @@ async def add_face(data: ImageData):
 @app.post("/upload_video")
 async def upload_video(video: UploadFile = File(...), name: str = None):
     try:
-        print(f"Received file: {video.filename}, Content-Type: {video.content_type}")
-        # Create videos directory if it doesn't exist
-        videos_dir = "videos"
-        if not os.path.exists(videos_dir):
-            os.makedirs(videos_dir)
-        
-        # Save the uploaded video
-        video_path = os.path.join(videos_dir, "face_video.webm")
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
-        # --- Frame Extraction ---
-        frames_dir = os.path.join(videos_dir, "frames")
-        if not os.path.exists(frames_dir):
-            os.makedirs(frames_dir)
-        # Remove old frames
-        for f in os.listdir(frames_dir):
-            os.remove(os.path.join(frames_dir, f))
-        
-        cap = cv2.VideoCapture(video_path)
-        print("OpenCV opened video:", cap.isOpened())
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print("Total frames in video:", total_frames)
-        # If OpenCV can't open .webm or frame count is invalid, convert to .mp4 and try again
-        if (not cap.isOpened()) or (total_frames is None) or (total_frames <= 0) or (total_frames > 10000):
-            print("Trying to convert .webm to .mp4 for OpenCV compatibility...")
-            mp4_path = os.path.join(videos_dir, "face_video.mp4")
-            subprocess.run([
-                "ffmpeg", "-y", "-i", video_path, mp4_path
-            ], check=True)
-            cap.release()
-            cap = cv2.VideoCapture(mp4_path)
-            print("OpenCV opened mp4 video:", cap.isOpened())
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            print("Total frames in mp4 video:", total_frames)
-        if (not cap.isOpened()) or (total_frames is None) or (total_frames <= 0) or (total_frames > 10000):
-            print("ERROR: Could not extract frames from video. Skipping frame extraction.")
-            cap.release()
-            return JSONResponse(content={
-                "success": False,
-                "message": "Video uploaded, but frame extraction failed (invalid video or codec)",
-                "video_path": video_path,
-                "frames_dir": frames_dir,
-                "name": name
-            })
-        num_extract = 10
-        if total_frames < num_extract:
-            num_extract = total_frames
-        frame_indices = [int(i * total_frames / num_extract) for i in range(num_extract)]
-        extracted = 0
-        idx = 0
-        while cap.isOpened() and extracted < num_extract:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if idx in frame_indices:
-                frame_path = os.path.join(frames_dir, f"frame_{extracted+1:02d}.jpg")
-                cv2.imwrite(frame_path, frame)
-                extracted += 1
-            idx += 1
-        cap.release()
-        
-        # --- Liveness Detection ---
-        mp_face_mesh = mp.solutions.face_mesh
-        liveness_report = {
-            'blink': False,
-            'mouth_movement': False,
-            'head_movement': False,
-            'details': {}
-        }
-        EAR_THRESH = 0.21
-        MAR_THRESH = 0.6
-        min_head_movement = 10  # pixels
-        left_eye_idx = [33, 160, 158, 133, 153, 144]
-        right_eye_idx = [362, 385, 387, 263, 373, 380]
-        mouth_idx = [61, 291, 81, 178, 13, 14, 17, 402, 318, 324, 308, 415]
-        nose_idx = 1
-        all_ear = []
-        all_mar = []
-        all_nose_x = []
-        all_nose_y = []
-        with mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True) as face_mesh:
-            for i in range(1, extracted+1):
-                frame_path = os.path.join(frames_dir, f"frame_{i:02d}.jpg")
-                image = cv2.imread(frame_path)
-                if image is None:
-                    continue
-                rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                results = face_mesh.process(rgb)
-                if not results.multi_face_landmarks:
-                    continue
-                landmarks = results.multi_face_landmarks[0].landmark
-                h, w, _ = image.shape
-                # Eye aspect ratio (EAR)
-                def get_ear(indices):
-                    p = [landmarks[idx] for idx in indices]
-                    p = [(int(pt.x * w), int(pt.y * h)) for pt in p]
-                    A = np.linalg.norm(np.array(p[1]) - np.array(p[5]))
-                    B = np.linalg.norm(np.array(p[2]) - np.array(p[4]))
-                    C = np.linalg.norm(np.array(p[0]) - np.array(p[3]))
-                    ear = (A + B) / (2.0 * C)
-                    return ear
-                left_ear = get_ear(left_eye_idx)
-                right_ear = get_ear(right_eye_idx)
-                avg_ear = (left_ear + right_ear) / 2.0
-                all_ear.append(avg_ear)
-                # Mouth aspect ratio (MAR)
-                def get_mar(indices):
-                    p = [landmarks[idx] for idx in indices]
-                    p = [(int(pt.x * w), int(pt.y * h)) for pt in p]
-                    A = np.linalg.norm(np.array(p[2]) - np.array(p[10]))
-                    B = np.linalg.norm(np.array(p[4]) - np.array(p[8]))
-                    C = np.linalg.norm(np.array(p[0]) - np.array(p[6]))
-                    mar = (A + B) / (2.0 * C)
-                    return mar
-                mar = get_mar(mouth_idx)
-                all_mar.append(mar)
-                # Nose position for head movement
-                nose = landmarks[nose_idx]
-                all_nose_x.append(nose.x * w)
-                all_nose_y.append(nose.y * h)
-        # Blink detection: EAR drops below threshold in any frame
-        if len(all_ear) > 1 and min(all_ear) < EAR_THRESH and max(all_ear) > EAR_THRESH:
-            liveness_report['blink'] = True
-        liveness_report['details']['ear'] = all_ear
-        # Mouth movement: MAR changes significantly
-        if len(all_mar) > 1 and (max(all_mar) - min(all_mar)) > MAR_THRESH:
-            liveness_report['mouth_movement'] = True
-        # Head movement: nose x/y changes significantly
-        if len(all_nose_x) > 1 and (max(all_nose_x) - min(all_nose_x) > min_head_movement or max(all_nose_y) - min(all_nose_y) > min_head_movement):
-            liveness_report['head_movement'] = True
-        liveness_report['details']['nose_x'] = all_nose_x
-        liveness_report['details']['nose_y'] = all_nose_y
-        # Final liveness decision: at least 2 of 3
-        liveness_score = sum([liveness_report['blink'], liveness_report['mouth_movement'], liveness_report['head_movement']])
-        liveness_report['liveness'] = liveness_score >= 2
-        liveness_report['score'] = liveness_score
-        
-        return JSONResponse(content={
-            "success": True,
-            "message": f"Video uploaded and {extracted} frames extracted",
-            "video_path": video_path,
-            "frames_dir": frames_dir,
-            "name": name,
-            "liveness_report": liveness_report
-        })
+        logger.debug("Received file: %s, Content-Type: %s", video.filename, video.content_type)
+        with workspaces.create() as workspace:
+            video_path = await execution.run_io(workspace.save_upload, video, "face_video.webm")
+            return JSONResponse(content=await execution.run_model(pipelines.upload_video, video_path, name))
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -252,275 +313,43 @@ async def upload_video(video: UploadFile = File(...), name: str = None):
         )
 
 @app.post("/unlock_video")
-async def unlock_video(video: UploadFile = File(...), challenge: str = None):
+async def unlock_video(video: UploadFile = File(...), challenge: str = None, response: str = "full"):
+    if response not in RESPONSE_MODES:
+        return invalid_response_mode()
     try:
-        print(f"Received unlock video: {video.filename}, Content-Type: {video.content_type}, Challenge: {challenge}")
-        videos_dir = "videos"
-        if not os.path.exists(videos_dir):
-            os.makedirs(videos_dir)
-        video_path = os.path.join(videos_dir, "unlock_face_video.webm")
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        # Frame extraction (reuse logic)
-        frames_dir = os.path.join(videos_dir, "unlock_frames")
-        if not os.path.exists(frames_dir):
-            os.makedirs(frames_dir)
-        for f in os.listdir(frames_dir):
-            os.remove(os.path.join(frames_dir, f))
-        cap = cv2.VideoCapture(video_path)
-        print("OpenCV opened video:", cap.isOpened())
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print("Total frames in video:", total_frames)
-        if (not cap.isOpened()) or (total_frames is None) or (total_frames <= 0) or (total_frames > 10000):
-            print("Trying to convert .webm to .mp4 for OpenCV compatibility...")
-            mp4_path = os.path.join(videos_dir, "unlock_face_video.mp4")
-            subprocess.run([
-                "ffmpeg", "-y", "-i", video_path, mp4_path
-            ], check=True)
-            cap.release()
-            cap = cv2.VideoCapture(mp4_path)
-            print("OpenCV opened mp4 video:", cap.isOpened())
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            print("Total frames in mp4 video:", total_frames)
-        if (not cap.isOpened()) or (total_frames is None) or (total_frames <= 0) or (total_frames > 10000):
-            print("ERROR: Could not extract frames from video. Skipping frame extraction.")
-            cap.release()
-            return JSONResponse(content={
-                "success": False,
-                "message": "Video uploaded, but frame extraction failed (invalid video or codec)",
-                "video_path": video_path,
-                "frames_dir": frames_dir
-            })
-        num_extract = 10
-        if total_frames < num_extract:
-            num_extract = total_frames
-        frame_indices = [int(i * total_frames / num_extract) for i in range(num_extract)]
-        extracted = 0
-        idx = 0
-        frame_paths = []
-        while cap.isOpened() and extracted < num_extract:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if idx in frame_indices:
-                frame_path = os.path.join(frames_dir, f"frame_{extracted+1:02d}.jpg")
-                cv2.imwrite(frame_path, frame)
-                frame_paths.append(frame_path)
-                extracted += 1
-            idx += 1
-        cap.release()
-        # --- Liveness Detection (challenge-specific) ---
-        mp_face_mesh = mp.solutions.face_mesh
-        liveness_report = {
-            'challenge': challenge,
-            'challenge_passed': False,
-            'blink': False,
-            'turn_left': False,
-            'turn_right': False,
-            'open_mouth': False,
-            'smile': False,
-            'mouth_movement': False,
-            'head_movement': False,
-            'details': {}
-        }
-        EAR_THRESH = 0.21
-        MAR_THRESH = 0.6
-        min_head_movement = 10  # pixels
-        left_eye_idx = [33, 160, 158, 133, 153, 144]
-        right_eye_idx = [362, 385, 387, 263, 373, 380]
-        mouth_idx = [61, 291, 81, 178, 13, 14, 17, 402, 318, 324, 308, 415]
-        smile_idx = [61, 291, 78, 308, 13, 14, 17, 402, 318, 324, 308, 415]
-        nose_idx = 1
-        all_ear = []
-        all_mar = []
-        all_nose_x = []
-        all_nose_y = []
-        all_smile = []
-        with mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True) as face_mesh:
-            for frame_path in frame_paths:
-                image = cv2.imread(frame_path)
-                if image is None:
-                    continue
-                rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                results = face_mesh.process(rgb)
-                if not results.multi_face_landmarks:
-                    continue
-                landmarks = results.multi_face_landmarks[0].landmark
-                h, w, _ = image.shape
-                def get_ear(indices):
-                    p = [landmarks[idx] for idx in indices]
-                    p = [(int(pt.x * w), int(pt.y * h)) for pt in p]
-                    A = np.linalg.norm(np.array(p[1]) - np.array(p[5]))
-                    B = np.linalg.norm(np.array(p[2]) - np.array(p[4]))
-                    C = np.linalg.norm(np.array(p[0]) - np.array(p[3]))
-                    ear = (A + B) / (2.0 * C)
-                    return ear
-                left_ear = get_ear(left_eye_idx)
-                right_ear = get_ear(right_eye_idx)
-                avg_ear = (left_ear + right_ear) / 2.0
-                all_ear.append(avg_ear)
-                def get_mar(indices):
-                    p = [landmarks[idx] for idx in indices]
-                    p = [(int(pt.x * w), int(pt.y * h)) for pt in p]
-                    A = np.linalg.norm(np.array(p[2]) - np.array(p[10]))
-                    B = np.linalg.norm(np.array(p[4]) - np.array(p[8]))
-                    C = np.linalg.norm(np.array(p[0]) - np.array(p[6]))
-                    mar = (A + B) / (2.0 * C)
-                    return mar
-                mar = get_mar(mouth_idx)
-                all_mar.append(mar)
-                # Smile: difference between mouth corners and top/bottom
-                smile_val = abs(landmarks[61].y - landmarks[291].y) / (abs(landmarks[13].y - landmarks[14].y) + 1e-6)
-                all_smile.append(smile_val)
-                # Nose position for head movement
-                nose = landmarks[nose_idx]
-                all_nose_x.append(nose.x * w)
-                all_nose_y.append(nose.y * h)
-        # Blink detection: EAR drops below threshold in any frame
-        if len(all_ear) > 1 and min(all_ear) < EAR_THRESH and max(all_ear) > EAR_THRESH:
-            liveness_report['blink'] = True
-        # Mouth movement: MAR changes significantly
-        if len(all_mar) > 1 and (max(all_mar) - min(all_mar)) > MAR_THRESH:
-            liveness_report['mouth_movement'] = True
-        # Head movement: nose x/y changes significantly
-        if len(all_nose_x) > 1 and (max(all_nose_x) - min(all_nose_x) > min_head_movement or max(all_nose_y) - min(all_nose_y) > min_head_movement):
-            liveness_report['head_movement'] = True
-        # Turn left: nose x decreases significantly
-        if len(all_nose_x) > 1 and (all_nose_x[0] - min(all_nose_x) > min_head_movement):
-            liveness_report['turn_left'] = True
-        # Turn right: nose x increases significantly
-        if len(all_nose_x) > 1 and (max(all_nose_x) - all_nose_x[0] > min_head_movement):
-            liveness_report['turn_right'] = True
-        # Open mouth: MAR exceeds threshold in any frame
-        if len(all_mar) > 1 and max(all_mar) > 0.8:
-            liveness_report['open_mouth'] = True
-        # Smile: smile_val increases significantly
-        if len(all_smile) > 1 and (max(all_smile) - min(all_smile)) > 0.15:
-            liveness_report['smile'] = True
-        liveness_report['details']['ear'] = all_ear
-        liveness_report['details']['mar'] = all_mar
-        liveness_report['details']['nose_x'] = all_nose_x
-        liveness_report['details']['nose_y'] = all_nose_y
-        liveness_report['details']['smile'] = all_smile
-        # Challenge-specific pass
-        if challenge == 'blink' and liveness_report['blink']:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'turn_left' and liveness_report['turn_left']:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'turn_right' and liveness_report['turn_right']:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'open_mouth' and liveness_report['open_mouth']:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'smile' and liveness_report['smile']:
-            liveness_report['challenge_passed'] = True
-        # Only pass liveness if challenge is met
-        liveness_report['liveness'] = liveness_report['challenge_passed']
-        liveness_report['score'] = liveness_report['challenge_passed'] # Changed to challenge_passed
-        # --- Face Recognition if liveness passed ---
-        recognition_result = None
-        if liveness_report['liveness']:
-            best_score = -1
-            best_identity = None
-            best_processed_image = None
-            best_match_status = False
-            for frame_path in frame_paths:
-                _, buffer = cv2.imencode('.jpg', cv2.imread(frame_path))
-                import base64
-                img_base64 = base64.b64encode(buffer).decode('utf-8')
-                match_status, score_raw, processed_image, name = recognizer.recognize(f"data:image/jpeg;base64,{img_base64}")
-                score = float(score_raw)
-                if score > best_score:
-                    best_score = score
-                    best_identity = name
-                    best_processed_image = processed_image
-                    best_match_status = bool(match_status)
-            recognition_result = {
-                "success": best_match_status,
-                "identity": best_identity,
-                "score": best_score,
-                "processed_image": best_processed_image
-            }
-        return JSONResponse(content={
-            "success": True,
-            "liveness_report": liveness_report,
-            "recognition_result": recognition_result
-        })
+        logger.debug("Received unlock video: %s, Content-Type: %s, Challenge: %s", video.filename, video.content_type, challenge)
+        with workspaces.create() as workspace:
+            video_path = await execution.run_io(workspace.save_upload, video, "unlock_face_video.webm")
+            return await run_model_cached(workspace.digests[video_path], (challenge, response),
+                                          pipelines.unlock_video, video_path, challenge, response, workspace=workspace)
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
     except Exception as e:
-        import traceback
-        print(f"ERROR: Exception in /unlock_video endpoint: {e}")
-        traceback.print_exc()
+        logger.exception("Exception in /unlock_video endpoint")
         return JSONResponse(
             status_code=500,
             content={"error": f"Failed to process unlock video: {str(e)}"}
         )
 
 @app.post("/unlock_face")
-async def unlock_face_api(video: UploadFile = File(None), image: str = Form(None)):
+async def unlock_face_api(video: UploadFile = File(None), image: str = Form(None), response: str = "full"):
+    if response not in RESPONSE_MODES:
+        return invalid_response_mode()
     try:
         # Accept either a video or a base64 image
-        if video is not None:
-            videos_dir = "videos"
-            if not os.path.exists(videos_dir):
-                os.makedirs(videos_dir)
-            video_path = os.path.join(videos_dir, "unlock_face_video_step1.webm")
-            with open(video_path, "wb") as buffer:
-                shutil.copyfileobj(video.file, buffer)
-            # Extract middle frame for recognition
-            cap = cv2.VideoCapture(video_path)
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            if not cap.isOpened() or total_frames <= 0 or total_frames > 10000:
-                mp4_path = os.path.join(videos_dir, "unlock_face_video_step1.mp4")
-                subprocess.run([
-                    "ffmpeg", "-y", "-i", video_path, mp4_path
-                ], check=True)
-                cap.release()
-                cap = cv2.VideoCapture(mp4_path)
-                total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            if not cap.isOpened() or total_frames <= 0 or total_frames > 10000:
-                return JSONResponse(content={"success": False, "message": "Could not process video for recognition."})
-            mid_idx = total_frames // 2
-            idx = 0
-            frame = None
-            while cap.isOpened():
-                ret, f = cap.read()
-                if not ret:
-                    break
-                if idx == mid_idx:
-                    frame = f
-                    break
-                idx += 1
-            cap.release()
-            if frame is None:
-                return JSONResponse(content={"success": False, "message": "Could not extract frame for recognition."})
-            _, buffer = cv2.imencode('.jpg', frame)
-            import base64
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            img_data = f"data:image/jpeg;base64,{img_base64}"
-        elif image is not None:
-            img_data = image
-        else:
-            return JSONResponse(content={"success": False, "message": "No video or image provided."})
-        # Run recognition only
-        match_status, score_raw, processed_image, name = recognizer.recognize(img_data)
-        # Only succeed if a face is detected and matched
-        if match_status != "Match" or name == "Unknown" or float(score_raw) <= 0.5:
-            return JSONResponse(content={
-                "success": False,
-                "identity": name,
-                "score": float(score_raw),
-                "processed_image": processed_image,
-                "error": "No face detected or face not recognized. Please try again with your face clearly visible."
-            })
-        return JSONResponse(content={
-            "success": True,
-            "identity": name,
-            "score": float(score_raw),
-            "processed_image": processed_image
-        })
+        if video is None:
+            if image is None:
+                return JSONResponse(content=await execution.run_model(pipelines.unlock_face, None, None, response))
+            digest = await execution.run_io(result_cache.digest, image)
+            return await run_model_cached(digest, (response,), pipelines.unlock_face, None, image, response)
+        with workspaces.create() as workspace:
+            video_path = await execution.run_io(workspace.save_upload, video, "unlock_face_video_step1.webm")
+            return await run_model_cached(workspace.digests[video_path], (response,),
+                                          pipelines.unlock_face, video_path, image, response, workspace=workspace)
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
     except Exception as e:
-        import traceback
-        print(f"ERROR: Exception in /unlock_face endpoint: {e}")
-        traceback.print_exc()
+        logger.exception("Exception in /unlock_face endpoint")
         return JSONResponse(
             status_code=500,
             content={"error": f"Failed to process unlock face: {str(e)}"}
@@ -529,192 +358,67 @@ async def unlock_face_api(video: UploadFile = File(None), image: str = Form(None
 @app.post("/challenge_liveness")
 async def challenge_liveness(video: UploadFile = File(...), challenge: str = Form(...)):
     try:
-        print(f"Received challenge video: {video.filename}, Challenge: {challenge}")
-        videos_dir = "videos"
-        if not os.path.exists(videos_dir):
-            os.makedirs(videos_dir)
-        video_path = os.path.join(videos_dir, "challenge_liveness_video.webm")
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        # Frame extraction (reuse logic)
-        frames_dir = os.path.join(videos_dir, "challenge_frames")
-        if not os.path.exists(frames_dir):
-            os.makedirs(frames_dir)
-        for f in os.listdir(frames_dir):
-            os.remove(os.path.join(frames_dir, f))
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print(f"Total frames in video: {total_frames}")
-        if (not cap.isOpened()) or (total_frames is None) or (total_frames <= 0) or (total_frames > 10000):
-            mp4_path = os.path.join(videos_dir, "challenge_liveness_video.mp4")
-            subprocess.run([
-                "ffmpeg", "-y", "-i", video_path, mp4_path
-            ], check=True)
-            cap.release()
-            cap = cv2.VideoCapture(mp4_path)
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            print(f"Total frames in mp4 video: {total_frames}")
-        if (not cap.isOpened()) or (total_frames is None) or (total_frames <= 0) or (total_frames > 10000):
-            cap.release()
-            print("ERROR: Could not process video for liveness.")
-            return JSONResponse(content={"success": False, "message": "Could not process video for liveness."})
-        num_extract = 10
-        if total_frames < num_extract:
-            num_extract = total_frames
-        frame_indices = [int(i * total_frames / num_extract) for i in range(num_extract)]
-        extracted = 0
-        idx = 0
-        frame_paths = []
-        while cap.isOpened() and extracted < num_extract:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if idx in frame_indices:
-                frame_path = os.path.join(frames_dir, f"frame_{extracted+1:02d}.jpg")
-                cv2.imwrite(frame_path, frame)
-                frame_paths.append(frame_path)
-                extracted += 1
-            idx += 1
-        cap.release()
-        print(f"Extracted {len(frame_paths)} frames for liveness analysis.")
-        # --- Challenge-specific liveness detection (reuse logic from unlock_video) ---
-        mp_face_mesh = mp.solutions.face_mesh
-        mp_hands = mp.solutions.hands
-        liveness_report = {
-            'challenge': challenge,
-            'challenge_passed': False,
-            'blink': False,
-            'turn_left': False,
-            'turn_right': False,
-            'open_mouth': False,
-            'show_two_fingers': False,
-            'show_one_hand': False,
-            'thumbs_up': False,
-            'mouth_movement': False,
-            'head_movement': False,
-            'details': {}
-        }
-        # Restore previous thresholds for gestures
-        EAR_THRESH = 0.21
-        MAR_THRESH = 0.4  # Previous value for open mouth
-        min_head_movement = 8  # Previous value for head movement
-        FINGER_CONFIDENCE = 0.05  # Allow tip to be just above pip
-        left_eye_idx = [33, 160, 158, 133, 153, 144]
-        right_eye_idx = [362, 385, 387, 263, 373, 380]
-        mouth_idx = [61, 291, 81, 178, 13, 14, 17, 402, 318, 324, 308, 415]
-        smile_idx = [61, 291, 78, 308, 13, 14, 17, 402, 318, 324, 308, 415]
-        nose_idx = 1
-        all_ear = []
-        all_mar = []
-        all_nose_x = []
-        all_nose_y = []
-        all_smile = []
-        faces_detected = 0
-        two_fingers_detected = False
-        hand_detected = False
-        smile_detected = False
-        open_mouth_detected = False
-        blink_detected = False
-        thumbs_up_detected = False
-        with mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True) as face_mesh, \
-             mp_hands.Hands(static_image_mode=True, max_num_hands=2, min_detection_confidence=0.7) as hands:
-            for frame_path in frame_paths:
-                image = cv2.imread(frame_path)
-                if image is None:
-                    print(f"Could not read frame: {frame_path}")
-                    continue
-                rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                # Face mesh processing (existing)
-                results = face_mesh.process(rgb)
-                if results.multi_face_landmarks:
-                    landmarks = results.multi_face_landmarks[0].landmark
-                    h, w, _ = image.shape
-                    def get_ear(indices):
-                        p = [landmarks[idx] for idx in indices]
-                        p = [(int(pt.x * w), int(pt.y * h)) for pt in p]
-                        A = np.linalg.norm(np.array(p[1]) - np.array(p[5]))
-                        B = np.linalg.norm(np.array(p[2]) - np.array(p[4]))
-                        C = np.linalg.norm(np.array(p[0]) - np.array(p[3]))
-                        ear = (A + B) / (2.0 * C)
-                        return ear
-                    left_ear = get_ear(left_eye_idx)
-                    right_ear = get_ear(right_eye_idx)
-                    avg_ear = (left_ear + right_ear) / 2.0
-                    all_ear.append(avg_ear)
-                    def get_mar(indices):
-                        p = [landmarks[idx] for idx in indices]
-                        p = [(int(pt.x * w), int(pt.y * h)) for pt in p]
-                        A = np.linalg.norm(np.array(p[2]) - np.array(p[10]))
-                        B = np.linalg.norm(np.array(p[4]) - np.array(p[8]))
-                        C = np.linalg.norm(np.array(p[0]) - np.array(p[6]))
-                        mar = (A + B) / (2.0 * C)
-                        return mar
-                    mar = get_mar(mouth_idx)
-                    all_mar.append(mar)
-                    nose = landmarks[nose_idx]
-                    all_nose_x.append(nose.x * w)
-                    all_nose_y.append(nose.y * h)
-                    # Blink detection: EAR drops below threshold in any frame
-                    if avg_ear < EAR_THRESH:
-                        blink_detected = True
-                    # Open mouth detection
-                    if mar > MAR_THRESH:
-                        open_mouth_detected = True
-                # Hand detection for new gestures
-                hand_results = hands.process(rgb)
-                if hand_results.multi_hand_landmarks:
-                    hand_detected = True
-                    for hand_landmarks in hand_results.multi_hand_landmarks:
-                        finger_tips = [4, 8, 12, 16, 20]
-                        finger_pips = [2, 6, 10, 14, 18]
-                        fingers_up = []
-                        for tip, pip in zip(finger_tips, finger_pips):
-                            if hand_landmarks.landmark[tip].y < hand_landmarks.landmark[pip].y - FINGER_CONFIDENCE:
-                                fingers_up.append(1)
-                            else:
-                                fingers_up.append(0)
-                        num_fingers = sum(fingers_up)
-                        if num_fingers == 2:
-                            two_fingers_detected = True
-                        # Thumbs up: only thumb is up
-                        if fingers_up[0] == 1 and sum(fingers_up[1:]) == 0:
-                            thumbs_up_detected = True
-        # Debug print after all frames
-        print(f"[DEBUG FINAL] blink_detected: {blink_detected}, open_mouth_detected: {open_mouth_detected}, two_fingers_detected: {two_fingers_detected}, hand_detected: {hand_detected}, thumbs_up_detected: {thumbs_up_detected}")
-        liveness_report['show_two_fingers'] = two_fingers_detected
-        liveness_report['show_one_hand'] = hand_detected
-        liveness_report['thumbs_up'] = thumbs_up_detected
-        # Only pass the requested gesture
-        liveness_report['challenge_passed'] = False
-        if challenge == 'blink' and blink_detected:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'open_mouth' and open_mouth_detected:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'show_two_fingers' and two_fingers_detected:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'show_one_hand' and hand_detected and not thumbs_up_detected:
-            liveness_report['challenge_passed'] = True
-        elif challenge == 'thumbs_up' and thumbs_up_detected:
-            liveness_report['challenge_passed'] = True
-        liveness_report['liveness'] = liveness_report['challenge_passed']
-        liveness_report['score'] = sum([
-            liveness_report['blink'],
-            liveness_report['mouth_movement'],
-            liveness_report['head_movement'],
-            liveness_report['turn_left'],
-            liveness_report['turn_right'],
-            liveness_report['open_mouth']
-        ])
-        print(f"Final liveness_report: {liveness_report}")
-        return JSONResponse(content={
-            "success": liveness_report['liveness'],
-            "liveness_report": liveness_report
-        })
+        logger.debug("Received challenge video: %s, Challenge: %s", video.filename, challenge)
+        with workspaces.create() as workspace:
+            video_path = await execution.run_io(workspace.save_upload, video, "challenge_liveness_video.webm")
+            return await run_model_cached(workspace.digests[video_path], (challenge,),
+                                          pipelines.challenge_liveness, video_path, challenge, workspace=workspace)
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
     except Exception as e:
-        import traceback
-        print(f"ERROR: Exception in /challenge_liveness endpoint: {e}")
-        traceback.print_exc()
+        logger.exception("Exception in /challenge_liveness endpoint")
         return JSONResponse(
             status_code=500,
             content={"error": f"Failed to process challenge liveness: {str(e)}"}
         )
+
+@app.post("/bulk_enroll")
+async def bulk_enroll_api(archive: UploadFile = File(...)):
+    try:
+        logger.debug("Received bulk enrollment archive: %s", archive.filename)
+        with workspaces.create() as workspace:
+            path = await execution.run_io(workspace.save_upload, archive, "enroll.zip", bulk_enroll.MAX_UPLOAD_BYTES)
+            # Opening the archive reads its directory; keep that off the event loop too.
+            with await execution.run_io(bulk_enroll.EnrollmentSource, path) as source:
+                return JSONResponse(content=await bulk_enroll.enroll(execution, source))
+    except (ServerBusy, WorkspaceQuotaExceeded, UploadTooLarge):
+        raise
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.exception("Exception in /bulk_enroll endpoint")
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"Failed to enroll faces: {str(e)}"}
+        )
+
+@app.get("/faces")
+async def list_faces(name: str = None):
+    return JSONResponse(content={"faces": await execution.run_io(gallery.list, name)})
+
+@app.get("/faces/{face_id}/thumbnail")
+async def face_thumbnail(face_id: str):
+    thumbnail = await execution.run_io(gallery.thumbnail, face_id)
+    if thumbnail is None:
+        return JSONResponse(status_code=404, content={"error": f"No face with ID: {face_id}"})
+    return Response(content=thumbnail, media_type="image/jpeg")
+
+@app.patch("/faces/{face_id}")
+async def rename_face(face_id: str, data: FaceName):
+    if not data.name:
+        return JSONResponse(status_code=400, content={"error": "Name is required"})
+    if not await execution.run_io(gallery.rename, face_id, data.name):
+        return JSONResponse(status_code=404, content={"error": f"No face with ID: {face_id}"})
+    return JSONResponse(content={"success": True, "face_id": face_id, "name": data.name})
+
+@app.delete("/faces/{face_id}")
+async def remove_face(face_id: str):
+    if not await execution.run_io(gallery.remove, face_id):
+        return JSONResponse(status_code=404, content={"error": f"No face with ID: {face_id}"})
+    return JSONResponse(content={"success": True, "face_id": face_id})
+
+@app.websocket("/ws/unlock")
+async def unlock_stream_ws(websocket: WebSocket, challenge: str = "blink", response: str = "none"):
+    # Live frames in, verdict out as soon as the challenge is met and the face matched
+    logging_config.request_id.set(request_id_from(websocket.headers))
+    await unlock_stream.serve(websocket, execution, challenge, response, workspaces.max_upload_bytes)
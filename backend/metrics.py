@@ -0,0 +1,196 @@
+"""
+Latency metrics, served by GET /metrics in the Prometheus text format.
+
+Model work is timed stage by stage inside the workers (`with metrics.stage("detect"):`).
+A worker process cannot update the server's registry, so collect() records the
+stage timings of one job and returns them with its result; ExecutionLayer.run_model
+then adds them to face_stage_seconds, labelled with the pipeline function that ran.
+Outside a job, stage() only costs an attribute lookup.
+"""
+import time
+import bisect
+import threading
+import contextlib
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds; spans a ~1 ms gallery match up to a slow video upload.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][slot] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Read at scrape time from `fn`, which returns a number, or {label values: number} with labels."""
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label_names = tuple(labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        values = self.fn()
+        if not self.label_names:
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+_metrics = {}
+
+
+def _register(metric):
+    # Re-registering a name replaces it, so a second ExecutionLayer reports its own pools.
+    _metrics[metric.name] = metric
+    return metric
+
+
+def gauge(name, help, fn, labels=()):
+    return _register(Gauge(name, help, fn, labels))
+
+
+def render():
+    lines = []
+    for metric in _metrics.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = _register(Histogram(
+    'face_request_seconds', 'HTTP request latency by endpoint.', ('endpoint', 'method')))
+REQUESTS = _register(Counter(
+    'face_requests_total', 'HTTP requests by endpoint and status code.', ('endpoint', 'method', 'status')))
+STAGE_SECONDS = _register(Histogram(
+    'face_stage_seconds', 'Time spent in each processing stage of a model job.', ('pipeline', 'stage')))
+MODEL_JOB_SECONDS = _register(Histogram(
+    'face_model_job_seconds', 'Model job run time inside a worker.', ('pipeline',)))
+MODEL_QUEUE_SECONDS = _register(Histogram(
+    'face_model_queue_seconds', 'Time a model job spent waiting for a worker, including the hand-off.', ('pipeline',)))
+MODEL_JOBS = _register(Counter(
+    'face_model_jobs_total', 'Model jobs by outcome.', ('pipeline', 'outcome')))
+IO_SECONDS = _register(Histogram(
+    'face_io_seconds', 'Blocking I/O job run time (saving uploads, gallery reads and writes).', ('task',)))
+REJECTED = _register(Counter(
+    'face_rejected_total', 'Jobs refused with a 503 because their pool was saturated.', ('pool',)))
+CACHE_REQUESTS = _register(Counter(
+    'face_cache_requests_total', 'Result cache lookups: hit, miss, or joined an identical request in flight.',
+    ('pipeline', 'result')))
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage of the current model job; a no-op outside collect()."""
+    observations = getattr(_local, 'observations', None)
+    if observations is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observations.append((name, time.perf_counter() - start))
+
+
+def collect(fn, *args):
+    """
+    Run fn(*args) in a worker and return (result, [(stage, seconds)], seconds). If it
+    raises, the timings ride along on the exception as `stage_observations`.
+    """
+    observations = _local.observations = []
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        e.stage_observations = (observations, time.perf_counter() - start)
+        raise
+    finally:
+        _local.observations = None
+    return result, observations, time.perf_counter() - start
+
+
+def record_job(pipeline, outcome, observations, job_seconds, total_seconds):
+    """Merge one model job's worker-side timings into the registry (server process)."""
+    MODEL_JOBS.inc(pipeline=pipeline, outcome=outcome)
+    for name, seconds in observations:
+        STAGE_SECONDS.observe(seconds, pipeline=pipeline, stage=name)
+    if job_seconds is not None:
+        MODEL_JOB_SECONDS.observe(job_seconds, pipeline=pipeline)
+        MODEL_QUEUE_SECONDS.observe(max(total_seconds - job_seconds, 0.0), pipeline=pipeline)
+
+
+def record_request(endpoint, method, status, seconds):
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, method=method)
+    REQUESTS.inc(endpoint=endpoint, method=method, status=str(status))
@@ -0,0 +1,122 @@
+"""
+Reusable MediaPipe FaceMesh / Hands instances.
+
+Building a MediaPipe graph costs far more than running it on one frame, so each
+worker keeps pools of ready instances and requests check one out for the length
+of a clip. An instance is only ever used by one request at a time.
+
+Set FACE_MESH_TRACKING=1 to process the frames of a clip with
+static_image_mode=False: after the first detection MediaPipe tracks the face/hands
+from frame to frame instead of running full detection on every frame. Tracking
+instances are reset on checkout so no state leaks between clips.
+"""
+import os
+import queue
+import threading
+import logging
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+TRACKING = os.environ.get("FACE_MESH_TRACKING") == "1"
+
+
+class ModelPool:
+    def __init__(self, name, factory, max_size=8, warm=1, reset_on_checkout=False):
+        self.name = name
+        self.factory = factory
+        self.max_size = max_size
+        self.reset_on_checkout = reset_on_checkout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        for _ in range(warm):
+            self._created += 1
+            self._idle.put(self._create())
+
+    def _create(self):
+        """Build an instance for a slot already counted in _created; gives the slot back on failure."""
+        try:
+            return self.factory()
+        except BaseException:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _take(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        # Claim the slot before building, so concurrent checkouts cannot overshoot max_size.
+        with self._lock:
+            can_grow = self._created < self.max_size
+            if can_grow:
+                self._created += 1
+        if can_grow:
+            return self._create()
+        return self._idle.get()
+
+    @contextlib.contextmanager
+    def checkout(self):
+        instance = self._take()
+        try:
+            if self.reset_on_checkout:
+                instance.reset()
+            yield instance
+        finally:
+            self._idle.put(instance)
+
+    @property
+    def in_use(self):
+        return self._created - self._idle.qsize()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+
+
+# mediapipe is imported by the factories, i.e. only in processes that build graphs.
+def _face_mesh_factory(static_image_mode):
+    import mediapipe as mp
+    return lambda: mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=static_image_mode, max_num_faces=1, refine_landmarks=True)
+
+
+def _hands_factory(static_image_mode):
+    import mediapipe as mp
+    return lambda: mp.solutions.hands.Hands(
+        static_image_mode=static_image_mode, max_num_hands=2, min_detection_confidence=0.7)
+
+
+def init_pools(max_size=8, warm=1):
+    """Build the pools for this process, pre-initialising `warm` instances of the mode in use."""
+    static_warm, tracking_warm = (0, warm) if TRACKING else (warm, 0)
+    _pools['face_mesh'] = ModelPool('face_mesh', _face_mesh_factory(True), max_size, static_warm)
+    _pools['face_mesh_tracking'] = ModelPool('face_mesh_tracking', _face_mesh_factory(False), max_size,
+                                             tracking_warm, reset_on_checkout=True)
+    _pools['hands'] = ModelPool('hands', _hands_factory(True), max_size, static_warm)
+    _pools['hands_tracking'] = ModelPool('hands_tracking', _hands_factory(False), max_size,
+                                         tracking_warm, reset_on_checkout=True)
+    logger.info("Model pools ready (%s mode).", 'tracking' if TRACKING else 'static image')
+
+
+def face_mesh(tracking=TRACKING):
+    """Check out a FaceMesh instance: `with model_pool.face_mesh() as face_mesh: ...`"""
+    return _pools['face_mesh_tracking' if tracking else 'face_mesh'].checkout()
+
+
+def hands(tracking=TRACKING):
+    return _pools['hands_tracking' if tracking else 'hands'].checkout()
+
+
+def close_pools():
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
@@ -0,0 +1,428 @@
+"""
+Model-heavy request handling for the FastAPI endpoints.
+
+Everything here runs inside an executor worker (see executor.py), never on the
+event loop. Each worker process calls init_worker() once, so the FaceRecognizer
+gallery, dlib and a pool of MediaPipe graphs (model_pool.py) are loaded, and run
+once on a sample frame (warmup()), before the first request lands.
+"""
+import os
+import time
+import logging
+import numpy as np
+from face_recognizer import FaceRecognizer, decode_image
+import frame_sampler
+import liveness_features
+import model_pool
+
+logger = logging.getLogger(__name__)
+
+# Padding around FaceMesh landmark extents when they stand in for the dlib detector's box
+FACE_BOX_PADDING = float(os.environ.get("FACE_BOX_PADDING", "0"))
+# Bundled frame every worker runs through the models at startup ("" skips the warmup)
+WARMUP_IMAGE = os.environ.get("FACE_WARMUP_IMAGE", "videos/frames/frame_01.jpg")
+
+recognizer = None
+
+
+def init_worker(known_faces_dir, index_backend="brute", index_params=None):
+    global recognizer
+    recognizer = FaceRecognizer(known_faces_dir, index_backend=index_backend, index_params=index_params)
+    model_pool.init_pools()
+    if WARMUP_IMAGE:
+        warmup(WARMUP_IMAGE)
+
+
+def warmup(image_path):
+    """
+    Run detection, encoding, FaceMesh and Hands once, so the first request does not
+    pay for their lazy initialisation (~125 ms on one core).
+    """
+    started = time.perf_counter()
+    try:
+        with open(image_path, 'rb') as f:
+            img = decode_image(f.read())
+    except OSError as e:
+        logger.warning("Skipping warmup: %s", e)
+        return
+    if img is None:
+        logger.warning("Skipping warmup: could not decode %s", image_path)
+        return
+    recognizer.recognize_frames([img], response='none')
+    with model_pool.face_mesh() as face_mesh, model_pool.hands() as hands:
+        liveness_features.extract_features([img], face_mesh, hands)
+    logger.info("Worker warm after %.0f ms warmup.", (time.perf_counter() - started) * 1000)
+
+
+def get_recognizer():
+    # Another worker may have enrolled a face since our last request.
+    recognizer.refresh()
+    return recognizer
+
+
+def recognize_image(image, response="full"):
+    """
+    Recognize a base64 string or raw image bytes; returns FaceRecognizer.recognize_frames()'s
+    result dict.
+    """
+    img = decode_image(image)
+    return get_recognizer().recognize_frames([img] if img is not None else [], response=response)
+
+
+def unlock_image(image, response="full"):
+    result = recognize_image(image, response)
+    match_status, name = result['status'], result['name']
+    score = float(result['similarity'])
+
+    # Only succeed if a face is detected and matched
+    if match_status == "No Match" or name == "Unknown" or score <= 0.5:
+        return {
+            "success": False,
+            "identity": name,
+            "score": score,
+            "box": result['box'],
+            "processed_image": result['processed_image'],
+            "error": "No face detected or face not recognized. Please try again or add your face."
+        }
+
+    return {
+        "success": True,
+        "identity": name,
+        "score": score,
+        "box": result['box'],
+        "processed_image": result['processed_image']
+    }
+
+
+def add_face(image, name):
+    img = decode_image(image)
+    if img is None:
+        raise Exception("Could not decode image")
+    return get_recognizer().add_reference_face_array(img, name)
+
+
+def encode_enrollment_image(image):
+    """Bulk enrollment, step 1 (runs per image, in parallel): (face crop JPEG, encoding)."""
+    img = decode_image(image)
+    if img is None:
+        raise Exception("Could not decode image")
+    return recognizer.encode_reference_face(img)
+
+
+def commit_enrollment(faces):
+    """Bulk enrollment, step 2 (runs once): add every encoded face to the gallery."""
+    return get_recognizer().add_reference_faces(faces)
+
+
+def _reported_paths(video_path, frames_dir):
+    """The workspace is gone once the response is sent; report the stable relative names."""
+    return {"video_path": os.path.join("videos", os.path.basename(video_path)),
+            "frames_dir": os.path.join("videos", os.path.basename(frames_dir))}
+
+
+def upload_video(video_path, name=None):
+    workspace_dir = os.path.dirname(video_path)
+
+    # --- Frame Extraction ---
+    frames_dir = os.path.join(workspace_dir, "frames")
+    frames = frame_sampler.sample_frames(video_path, debug_dir=frames_dir)
+    if frames is None:
+        logger.error("Could not extract frames from video. Skipping frame extraction.")
+        return {
+            "success": False,
+            "message": "Video uploaded, but frame extraction failed (invalid video or codec)",
+            **_reported_paths(video_path, frames_dir),
+            "name": name
+        }
+    extracted = len(frames)
+
+    # --- Liveness Detection ---
+    liveness_report = {
+        'blink': False,
+        'mouth_movement': False,
+        'head_movement': False,
+        'details': {}
+    }
+    EAR_THRESH = 0.21
+    MAR_THRESH = 0.6
+    min_head_movement = 10  # pixels
+    with model_pool.face_mesh() as face_mesh:
+        features, _, _ = liveness_features.extract_features(frames, face_mesh)
+    all_ear = features['ear'].tolist()
+    all_mar = features['mar'].tolist()
+    all_nose_x = features['nose_x'].tolist()
+    all_nose_y = features['nose_y'].tolist()
+    # Blink detection: EAR drops below threshold in any frame
+    if len(all_ear) > 1 and min(all_ear) < EAR_THRESH and max(all_ear) > EAR_THRESH:
+        liveness_report['blink'] = True
+    liveness_report['details']['ear'] = all_ear
+    # Mouth movement: MAR changes significantly
+    if len(all_mar) > 1 and (max(all_mar) - min(all_mar)) > MAR_THRESH:
+        liveness_report['mouth_movement'] = True
+    # Head movement: nose x/y changes significantly
+    if len(all_nose_x) > 1 and (max(all_nose_x) - min(all_nose_x) > min_head_movement or max(all_nose_y) - min(all_nose_y) > min_head_movement):
+        liveness_report['head_movement'] = True
+    liveness_report['details']['nose_x'] = all_nose_x
+    liveness_report['details']['nose_y'] = all_nose_y
+    # Final liveness decision: at least 2 of 3
+    liveness_score = sum([liveness_report['blink'], liveness_report['mouth_movement'], liveness_report['head_movement']])
+    liveness_report['liveness'] = liveness_score >= 2
+    liveness_report['score'] = liveness_score
+    
+    return {
+        "success": True,
+        "message": f"Video uploaded and {extracted} frames extracted",
+        **_reported_paths(video_path, frames_dir),
+        "name": name,
+        "liveness_report": liveness_report
+    }
+
+
+def face_challenge_report(all_ear, all_mar, all_nose_x, all_nose_y, all_smile, challenge):
+    """
+    Liveness report for the face challenges (blink, turn_left, turn_right, open_mouth,
+    smile) from per-frame feature lists. Shared by /unlock_video and /ws/unlock.
+    """
+    liveness_report = {
+        'challenge': challenge,
+        'challenge_passed': False,
+        'blink': False,
+        'turn_left': False,
+        'turn_right': False,
+        'open_mouth': False,
+        'smile': False,
+        'mouth_movement': False,
+        'head_movement': False,
+        'details': {}
+    }
+    EAR_THRESH = 0.21
+    MAR_THRESH = 0.6
+    min_head_movement = 10  # pixels
+    # Blink detection: EAR drops below threshold in any frame
+    if len(all_ear) > 1 and min(all_ear) < EAR_THRESH and max(all_ear) > EAR_THRESH:
+        liveness_report['blink'] = True
+    # Mouth movement: MAR changes significantly
+    if len(all_mar) > 1 and (max(all_mar) - min(all_mar)) > MAR_THRESH:
+        liveness_report['mouth_movement'] = True
+    # Head movement: nose x/y changes significantly
+    if len(all_nose_x) > 1 and (max(all_nose_x) - min(all_nose_x) > min_head_movement or max(all_nose_y) - min(all_nose_y) > min_head_movement):
+        liveness_report['head_movement'] = True
+    # Turn left: nose x decreases significantly
+    if len(all_nose_x) > 1 and (all_nose_x[0] - min(all_nose_x) > min_head_movement):
+        liveness_report['turn_left'] = True
+    # Turn right: nose x increases significantly
+    if len(all_nose_x) > 1 and (max(all_nose_x) - all_nose_x[0] > min_head_movement):
+        liveness_report['turn_right'] = True
+    # Open mouth: MAR exceeds threshold in any frame
+    if len(all_mar) > 1 and max(all_mar) > 0.8:
+        liveness_report['open_mouth'] = True
+    # Smile: smile_val increases significantly
+    if len(all_smile) > 1 and (max(all_smile) - min(all_smile)) > 0.15:
+        liveness_report['smile'] = True
+    liveness_report['details']['ear'] = all_ear
+    liveness_report['details']['mar'] = all_mar
+    liveness_report['details']['nose_x'] = all_nose_x
+    liveness_report['details']['nose_y'] = all_nose_y
+    liveness_report['details']['smile'] = all_smile
+    # Challenge-specific pass
+    if challenge == 'blink' and liveness_report['blink']:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'turn_left' and liveness_report['turn_left']:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'turn_right' and liveness_report['turn_right']:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'open_mouth' and liveness_report['open_mouth']:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'smile' and liveness_report['smile']:
+        liveness_report['challenge_passed'] = True
+    # Only pass liveness if challenge is met
+    liveness_report['liveness'] = liveness_report['challenge_passed']
+    liveness_report['score'] = liveness_report['challenge_passed'] # Changed to challenge_passed
+    return liveness_report
+
+
+def unlock_video(video_path, challenge=None, response="full"):
+    workspace_dir = os.path.dirname(video_path)
+    frames_dir = os.path.join(workspace_dir, "unlock_frames")
+    frames = frame_sampler.sample_frames(video_path, debug_dir=frames_dir)
+    if frames is None:
+        logger.error("Could not extract frames from video. Skipping frame extraction.")
+        return {
+            "success": False,
+            "message": "Video uploaded, but frame extraction failed (invalid video or codec)",
+            **_reported_paths(video_path, frames_dir)
+        }
+    # --- Liveness Detection (challenge-specific) ---
+    with model_pool.face_mesh() as face_mesh:
+        features, _, face_landmarks = liveness_features.extract_features(frames, face_mesh)
+    liveness_report = face_challenge_report(features['ear'].tolist(), features['mar'].tolist(),
+                                            features['nose_x'].tolist(), features['nose_y'].tolist(),
+                                            features['smile'].tolist(), challenge)
+    # --- Face Recognition if liveness passed ---
+    recognition_result = None
+    if liveness_report['liveness']:
+        recognizer = get_recognizer()
+        best_score = -1
+        best_identity = None
+        best_processed_image = None
+        best_box = None
+        best_match_status = False
+        if frames:
+            # FaceMesh already located the face, so dlib only detects in frames where it found none.
+            # Only the best frame is annotated and encoded.
+            locations = liveness_features.face_locations(features, face_landmarks, frames, FACE_BOX_PADDING)
+            result = recognizer.recognize_frames(frames, locations, response)
+            score = float(result['similarity'])
+            if score > best_score:
+                best_score = score
+                best_identity = result['name']
+                best_processed_image = result['processed_image']
+                best_box = result['box']
+                best_match_status = bool(result['status'])
+        recognition_result = {
+            "success": best_match_status,
+            "identity": best_identity,
+            "score": best_score,
+            "box": best_box,
+            "processed_image": best_processed_image
+        }
+    return {
+        "success": True,
+        "liveness_report": liveness_report,
+        "recognition_result": recognition_result
+    }
+
+
+def stream_frame(image, roi=None, recognize=True, response="none"):
+    """
+    Process one frame of a /ws/unlock session. Frames of a session may land on any
+    worker, so the session's state (the face box of its last frame) comes in as
+    `roi` and the caller keeps the rest. Returns {"features", "roi", "recognition"}:
+    the frame's liveness features (None without a face), its face box and, when
+    `recognize` is set, the recognition result using that box.
+    """
+    img = decode_image(image)
+    if img is None:
+        return {"features": None, "roi": None, "recognition": None}
+    with model_pool.face_mesh(tracking=False) as face_mesh:
+        landmarks = liveness_features.frame_landmarks(img, face_mesh, roi)
+    if landmarks is None:
+        return {"features": None, "roi": None, "recognition": None}
+    landmarks = landmarks[np.newaxis]
+    frame_size = np.array([img.shape[:2]])
+    table = liveness_features.face_feature_table(landmarks, frame_size, [0])
+    box = tuple(int(v) for v in liveness_features.face_boxes(landmarks, frame_size, FACE_BOX_PADDING)[0])
+    recognition = get_recognizer().recognize_frames([img], [[box]], response) if recognize else None
+    return {
+        "features": {name: float(table[name][0]) for name in ('ear', 'mar', 'smile', 'nose_x', 'nose_y')},
+        "roi": box,
+        "recognition": recognition
+    }
+
+
+def unlock_face(video_path=None, image=None, response="full"):
+    # Accept either a video or a base64 image
+    if video_path is not None:
+        # Extract middle frame for recognition
+        frames = frame_sampler.decode_frames(video_path, lambda total_frames: [total_frames // 2])
+        if frames is None:
+            return {"success": False, "message": "Could not process video for recognition."}
+        frame = frames[0] if frames else None
+        if frame is None:
+            return {"success": False, "message": "Could not extract frame for recognition."}
+        # Run recognition only
+        result = get_recognizer().recognize_frames([frame], response=response)
+    elif image is not None:
+        result = recognize_image(image, response)
+    else:
+        return {"success": False, "message": "No video or image provided."}
+    match_status, score_raw, name = result['status'], result['similarity'], result['name']
+    # Only succeed if a face is detected and matched
+    if match_status != "Match" or name == "Unknown" or float(score_raw) <= 0.5:
+        return {
+            "success": False,
+            "identity": name,
+            "score": float(score_raw),
+            "box": result['box'],
+            "processed_image": result['processed_image'],
+            "error": "No face detected or face not recognized. Please try again with your face clearly visible."
+        }
+    return {
+        "success": True,
+        "identity": name,
+        "score": float(score_raw),
+        "box": result['box'],
+        "processed_image": result['processed_image']
+    }
+
+
+def challenge_liveness(video_path, challenge):
+    workspace_dir = os.path.dirname(video_path)
+    frames_dir = os.path.join(workspace_dir, "challenge_frames")
+    frames = frame_sampler.sample_frames(video_path, debug_dir=frames_dir)
+    if frames is None:
+        logger.error("Could not process video for liveness.")
+        return {"success": False, "message": "Could not process video for liveness."}
+    logger.debug("Extracted %d frames for liveness analysis.", len(frames))
+    # --- Challenge-specific liveness detection (reuse logic from unlock_video) ---
+    liveness_report = {
+        'challenge': challenge,
+        'challenge_passed': False,
+        'blink': False,
+        'turn_left': False,
+        'turn_right': False,
+        'open_mouth': False,
+        'show_two_fingers': False,
+        'show_one_hand': False,
+        'thumbs_up': False,
+        'mouth_movement': False,
+        'head_movement': False,
+        'details': {}
+    }
+    # Restore previous thresholds for gestures
+    EAR_THRESH = 0.21
+    MAR_THRESH = 0.4  # Previous value for open mouth
+    FINGER_CONFIDENCE = 0.05  # Allow tip to be just above pip
+    with model_pool.face_mesh() as face_mesh, model_pool.hands() as hands:
+        features, hand_landmarks, _ = liveness_features.extract_features(frames, face_mesh, hands)
+    # Blink detection: EAR drops below threshold in any frame
+    blink_detected = bool(np.any(features['ear'] < EAR_THRESH))
+    # Open mouth detection
+    open_mouth_detected = bool(np.any(features['mar'] > MAR_THRESH))
+    # Hand detection for new gestures
+    fingers_up = liveness_features.fingers_up(hand_landmarks, FINGER_CONFIDENCE)
+    hand_detected = len(fingers_up) > 0
+    two_fingers_detected = bool(np.any(fingers_up.sum(axis=1) == 2))
+    # Thumbs up: only thumb is up
+    thumbs_up_detected = bool(np.any(fingers_up[:, 0] & ~fingers_up[:, 1:].any(axis=1)))
+    logger.debug("blink_detected: %s, open_mouth_detected: %s, two_fingers_detected: %s, hand_detected: %s, thumbs_up_detected: %s",
+                 blink_detected, open_mouth_detected, two_fingers_detected, hand_detected, thumbs_up_detected)
+    liveness_report['show_two_fingers'] = two_fingers_detected
+    liveness_report['show_one_hand'] = hand_detected
+    liveness_report['thumbs_up'] = thumbs_up_detected
+    # Only pass the requested gesture
+    liveness_report['challenge_passed'] = False
+    if challenge == 'blink' and blink_detected:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'open_mouth' and open_mouth_detected:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'show_two_fingers' and two_fingers_detected:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'show_one_hand' and hand_detected and not thumbs_up_detected:
+        liveness_report['challenge_passed'] = True
+    elif challenge == 'thumbs_up' and thumbs_up_detected:
+        liveness_report['challenge_passed'] = True
+    liveness_report['liveness'] = liveness_report['challenge_passed']
+    liveness_report['score'] = sum([
+        liveness_report['blink'],
+        liveness_report['mouth_movement'],
+        liveness_report['head_movement'],
+        liveness_report['turn_left'],
+        liveness_report['turn_right'],
+        liveness_report['open_mouth']
+    ])
+    logger.debug("Final liveness_report: %s", liveness_report)
+    return {
+        "success": liveness_report['liveness'],
+        "liveness_report": liveness_report
+    }
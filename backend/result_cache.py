@@ -0,0 +1,126 @@
+"""
+Cache of recognition and liveness results, keyed by what was uploaded.
+
+Clients on flaky networks retry, and re-submit the same frame or clip. A result is
+stored under (pipeline, SHA-256 of the uploaded bytes, request parameters such as
+the challenge and response mode), so a repeat is answered without decoding,
+detecting, encoding or running liveness again. A repeat that arrives while the
+first request is still being processed waits for that result instead of starting
+a second job.
+
+Results depend on the gallery, so every entry is tied to the gallery version
+(see GalleryStore.version): once any face is added, renamed or removed, from
+this process or a worker, the whole cache is dropped.
+
+Entries are the rendered JSON bodies, bounded in total by FACE_CACHE_MB (default
+64, 0 disables the cache) and expiring after FACE_CACHE_TTL seconds (default 300);
+the least recently used entries go first. Only the event loop thread touches the
+cache, so it needs no lock.
+"""
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+import metrics
+
+CACHE_MB = float(os.environ.get("FACE_CACHE_MB", "64"))
+CACHE_TTL = float(os.environ.get("FACE_CACHE_TTL", "300"))
+# Rough per-entry bookkeeping (key tuple, OrderedDict node), counted against the bound.
+ENTRY_OVERHEAD = 512
+
+
+def digest(content):
+    """SHA-256 of an upload: bytes, or the base64 string of a JSON body."""
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.sha256(content).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes=int(CACHE_MB * 1024 * 1024), ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version = -1
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (body, expires)
+        self._pending = {}  # (key, version) -> Future of the body being computed
+        metrics.gauge('face_cache_bytes', 'Bytes held by the result cache.', lambda: self.bytes)
+        metrics.gauge('face_cache_entries', 'Results held by the result cache.', lambda: len(self._entries))
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def _drop(self, key):
+        body, _ = self._entries.pop(key)
+        self.bytes -= len(body) + ENTRY_OVERHEAD
+
+    def get(self, key, version):
+        """The cached body for `key`, or None. A newer gallery version empties the cache."""
+        if version != self.version:
+            # Versions only grow; a request that read an older one just misses.
+            if version > self.version:
+                self.clear()
+                self.version = version
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, body, version):
+        if version != self.version:
+            return  # computed against a gallery that has changed since
+        size = len(body) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (body, time.monotonic() + self.ttl)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    async def get_or_compute(self, key, version, compute):
+        """
+        The body cached under `key` for this gallery version, else `await compute()`,
+        cached. The computation runs on after the caller is cancelled, for anyone who
+        joined it. key[0] names the pipeline for the hit/miss counter.
+        """
+        body = self.get(key, version)
+        if body is not None:
+            metrics.CACHE_REQUESTS.inc(pipeline=key[0], result="hit")
+            return body
+        pending = self._pending.get((key, version))
+        if pending is not None:
+            metrics.CACHE_REQUESTS.inc(pipeline=key[0], result="joined")
+            return await asyncio.shield(pending)
+
+        metrics.CACHE_REQUESTS.inc(pipeline=key[0], result="miss")
+        # Its own task, so a leader whose client goes away does not cancel the joiners.
+        task = self._pending[key, version] = asyncio.ensure_future(self._compute(key, version, compute))
+        task.add_done_callback(_retrieve)
+        return await asyncio.shield(task)
+
+    async def _compute(self, key, version, compute):
+        try:
+            body = await compute()
+        finally:
+            del self._pending[key, version]
+        self.put(key, body, version)
+        return body
+
+
+def _retrieve(task):
+    # Nobody may be waiting for a job whose leader was cancelled.
+    if not task.cancelled():
+        task.exception()
@@ -0,0 +1,272 @@
+"""
+The gallery's encoding matrix and name table in one memory-mapped file shared by
+every process serving it (known_faces/gallery.seg.<generation>).
+
+With `uvicorn --workers N`, each with its model workers, every process used to
+keep its own copy of the gallery. Now they all map the same segment read-only:
+its pages sit once in the OS page cache however many workers there are, and a
+worker starting up reads no encodings from the database.
+
+GalleryStore keeps the segment in step with the database: after every committed
+change it applies the change under the gallery's interprocess lock, then bumps the
+header's version.
+- An enrollment appends rows in place.
+- A rename writes the row's new name reference in place.
+- A removal leaves a tombstone (a zero face id reference) in place.
+- Once rows or names no longer fit, the segment is copied into a bigger next
+  generation with every row where it was (grow()).
+- Once tombstones are more than half the rows, the gallery is written out afresh
+  (build()), which renumbers the rows and so gets a new `layout`.
+Readers check the header on each request. A new version means rows were appended,
+renamed or removed. A retired (or deleted) segment means reopening the latest
+generation, and re-indexing only if its layout differs. The SQLite store stays the
+source of truth; a missing or unreadable segment is rebuilt from it.
+
+Layout: a header of HEADER int64 fields, then `capacity` rows of 128 float64
+encodings, `capacity` int64 name references, `capacity` int64 face id references
+and a heap of UTF-8 strings. A reference packs a heap offset and a length as
+(offset << 16) | length.
+"""
+import os
+import re
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'gallery.seg.'
+MAGIC = 0x46414345_53454732  # "FACESEG2"
+HEADER = ('magic', 'version', 'count', 'capacity', 'heap_size', 'heap_used', 'retired', 'generation',
+          'removed', 'layout')
+HEADER_BYTES = 8 * len(HEADER)
+ENCODING_SIZE = 128
+MAX_STRING = 0xFFFF
+
+
+def segment_path(directory, generation):
+    return os.path.join(directory, f"{SEGMENT_PREFIX}{generation}")
+
+
+def generations(directory):
+    """Generation numbers of the segments in `directory`, oldest first."""
+    found = []
+    for name in os.listdir(directory):
+        match = re.fullmatch(re.escape(SEGMENT_PREFIX) + r'(\d+)', name)
+        if match:
+            found.append(int(match.group(1)))
+    return sorted(found)
+
+
+def _encode(text):
+    return text.encode('utf-8')[:MAX_STRING]
+
+
+def _create(directory, capacity, heap_size):
+    """An empty next-generation file at its temporary path; returns (generation, tmp path, final path)."""
+    existing = generations(directory)
+    generation = existing[-1] + 1 if existing else 1
+    path = segment_path(directory, generation)
+    tmp = path + '.tmp'
+    size = HEADER_BYTES + capacity * (ENCODING_SIZE * 8 + 16) + heap_size
+    mm = np.memmap(tmp, dtype=np.uint8, mode='w+', shape=(size,))
+    header = mm[:HEADER_BYTES].view('<i8')
+    header[:] = 0
+    header[HEADER.index('magic')] = MAGIC
+    header[HEADER.index('capacity')] = capacity
+    header[HEADER.index('heap_size')] = heap_size
+    header[HEADER.index('generation')] = generation
+    mm.flush()
+    del header, mm
+    return generation, tmp, path
+
+
+def _publish(directory, tmp, path):
+    """Move a finished generation into place and retire (and remove) the older ones."""
+    os.replace(tmp, path)
+    for old_path in (segment_path(directory, g) for g in generations(directory)):
+        if old_path == path:
+            continue
+        try:
+            SharedGallery(old_path, writable=True)._set('retired', 1)
+        except (OSError, ValueError):
+            pass
+        try:
+            os.remove(old_path)  # readers keep their mapping; Windows refuses while mapped
+        except OSError:
+            pass
+
+
+class SharedGallery:
+    def __init__(self, path, writable=False):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode='r+' if writable else 'r')
+        self._inode = os.stat(path).st_ino
+        self._header = self._map[:HEADER_BYTES].view('<i8')
+        if self._get('magic') != MAGIC:
+            raise ValueError(f"{path} is not a gallery segment")
+        capacity = self._get('capacity')
+        offset = HEADER_BYTES
+        size = capacity * ENCODING_SIZE * 8
+        self.encodings = self._map[offset:offset + size].view('<f8').reshape(capacity, ENCODING_SIZE)
+        offset += size
+        self._names = self._map[offset:offset + capacity * 8].view('<i8')
+        offset += capacity * 8
+        self._face_ids = self._map[offset:offset + capacity * 8].view('<i8')
+        offset += capacity * 8
+        self._heap = self._map[offset:offset + self._get('heap_size')]
+
+    def _get(self, field):
+        return int(self._header[HEADER.index(field)])
+
+    def _set(self, field, value):
+        self._header[HEADER.index(field)] = value
+
+    # The header is shared, so these are read fresh on every access.
+    @property
+    def version(self):
+        return self._get('version')
+
+    @property
+    def count(self):
+        return self._get('count')
+
+    @property
+    def capacity(self):
+        return self._get('capacity')
+
+    @property
+    def removed(self):
+        """Tombstoned rows among the first `count`."""
+        return self._get('removed')
+
+    @property
+    def layout(self):
+        """Identifies the row numbering: kept by grow(), new with every build()."""
+        return self._get('layout')
+
+    @property
+    def current(self):
+        """False once a newer generation replaced this one, or its file is gone."""
+        if self._get('retired'):
+            return False
+        try:
+            return os.stat(self.path).st_ino == self._inode
+        except OSError:
+            return False
+
+    @classmethod
+    def open_latest(cls, directory, writable=False):
+        """The newest segment in `directory`, or None if there is none that opens."""
+        for generation in reversed(generations(directory)):
+            try:
+                return cls(segment_path(directory, generation), writable)
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping gallery segment %d: %s", generation, e)
+        return None
+
+    @classmethod
+    def build(cls, directory, faces, version):
+        """
+        Write (face_id, name, encoding) rows as a new generation and layout, with room
+        to grow, and retire the previous ones. Returns it opened for writing.
+        """
+        strings = [(_encode(face_id), _encode(name)) for face_id, name, _ in faces]
+        capacity = max(16, 2 * len(faces))
+        heap_used = sum(len(f) + len(n) for f, n in strings)
+        generation, tmp, path = _create(directory, capacity, max(64 * capacity, 2 * heap_used))
+        segment = cls(tmp, writable=True)
+        # Random rather than the generation, which starts over if every file is deleted.
+        segment._set('layout', int.from_bytes(os.urandom(7), 'little'))
+        if not segment.append(faces, version):
+            raise AssertionError("a fresh segment must fit its own rows")
+        segment._map.flush()
+        del segment
+        _publish(directory, tmp, path)
+        logger.info("Gallery segment %d: %d faces.", generation, len(faces))
+        return cls(path, writable=True)
+
+    def grow(self, directory):
+        """
+        Copy this segment into a new generation with twice the rows and heap, every row
+        and string at the same place (so the same layout), and retire this one.
+        Returns the new segment opened for writing.
+        """
+        count, heap_used = self.count, self._get('heap_used')
+        generation, tmp, path = _create(directory, 2 * self.capacity, 2 * len(self._heap))
+        grown = SharedGallery(tmp, writable=True)
+        grown.encodings[:count] = self.encodings[:count]
+        grown._names[:count] = self._names[:count]
+        grown._face_ids[:count] = self._face_ids[:count]
+        grown._heap[:heap_used] = self._heap[:heap_used]
+        for field in ('heap_used', 'removed', 'layout', 'count', 'version'):
+            grown._set(field, self._get(field))
+        grown._map.flush()
+        del grown
+        _publish(directory, tmp, path)
+        logger.info("Gallery segment %d: grown to %d rows.", generation, 2 * self.capacity)
+        return SharedGallery(path, writable=True)
+
+    def _store_string(self, data):
+        used = self._get('heap_used')
+        if used + len(data) > len(self._heap):
+            return None
+        self._heap[used:used + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self._set('heap_used', used + len(data))
+        return (used << 16) | len(data)
+
+    def _string(self, ref):
+        offset, length = ref >> 16, ref & MAX_STRING
+        return self._heap[offset:offset + length].tobytes().decode('utf-8', errors='replace')
+
+    def name(self, row):
+        return self._string(int(self._names[row]))
+
+    def face_id(self, row):
+        """The row's face id, or "" for a removed row."""
+        return self._string(int(self._face_ids[row]))
+
+    def alive(self, count):
+        """Boolean mask of the first `count` rows that are not tombstones."""
+        return self._face_ids[:count] != 0
+
+    def append(self, faces, version):
+        """
+        Append (face_id, name, encoding) rows and publish `version`. Returns False,
+        changing nothing visible, if they do not fit.
+        """
+        count = self.count
+        if count + len(faces) > self.capacity:
+            return False
+        heap_used = self._get('heap_used')
+        refs = []
+        for face_id, name, _ in faces:
+            face_ref, name_ref = self._store_string(_encode(face_id)), self._store_string(_encode(name))
+            if face_ref is None or name_ref is None:
+                self._set('heap_used', heap_used)
+                return False
+            refs.append((face_ref, name_ref))
+        for row, ((_, _, encoding), (face_ref, name_ref)) in enumerate(zip(faces, refs), count):
+            self.encodings[row] = encoding
+            self._face_ids[row] = face_ref
+            self._names[row] = name_ref
+        # Rows first, then the count that exposes them, then the version readers poll.
+        self._set('count', count + len(faces))
+        self._set('version', version)
+        return True
+
+    def rename(self, row, name):
+        """Point `row` at a new name (one 8-byte store readers see whole). False if the heap is full."""
+        ref = self._store_string(_encode(name))
+        if ref is None:
+            return False
+        self._names[row] = ref
+        return True
+
+    def remove(self, row):
+        """Tombstone `row`; readers drop it from their index on the next version."""
+        if self._face_ids[row] != 0:
+            self._face_ids[row] = 0
+            self._set('removed', self.removed + 1)
+
+    def publish(self, version):
+        self._set('version', version)
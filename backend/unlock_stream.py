@@ -0,0 +1,196 @@
+"""
+Streaming unlock over a WebSocket (/ws/unlock).
+
+The browser sends camera frames as they are captured; each one is processed as
+soon as a worker is free and the session answers with a verdict the moment the
+liveness challenge is met and the face is recognised, instead of after a whole
+clip has been recorded, uploaded and sampled.
+
+Protocol:
+    connect  /ws/unlock?challenge=blink[&response=none|thumbnail|full]
+    client → binary messages with one encoded frame (JPEG/PNG) each, or text
+             messages with a base64 data URL
+    server → {"type": "progress", "frame": n, "face": bool, "challenge_passed": bool,
+              "identity": ..., "score": ...} after every processed frame
+    server → {"type": "verdict", "success": bool, "reason": ..., "liveness_report": {...},
+              "recognition_result": {...}} once, then closes the socket
+
+Frames that arrive while the previous one is still being processed are dropped
+(only the newest is kept), so a slow server never falls behind the camera. A frame
+larger than the upload limit ends the session with an error and close code 1009.
+"""
+import os
+import time
+import asyncio
+import logging
+from fastapi import WebSocket, WebSocketDisconnect
+from executor import ServerBusy
+from face_recognizer import RESPONSE_MODES
+import pipelines
+
+logger = logging.getLogger(__name__)
+
+MAX_FRAMES = int(os.environ.get("FACE_STREAM_MAX_FRAMES", "300"))
+TIMEOUT = float(os.environ.get("FACE_STREAM_TIMEOUT", "20"))
+FEATURES = ('ear', 'mar', 'nose_x', 'nose_y', 'smile')
+# The face challenges of /unlock_video; hand gestures need the Hands model and stay on /challenge_liveness.
+CHALLENGES = ('blink', 'turn_left', 'turn_right', 'open_mouth', 'smile')
+
+
+class UnlockSession:
+    """Per-connection state: liveness features so far, the tracked face box and the best match."""
+
+    def __init__(self, challenge, max_frames=MAX_FRAMES, timeout=TIMEOUT):
+        self.challenge = challenge
+        self.max_frames = max_frames
+        self.deadline = time.monotonic() + timeout
+        self.features = {name: [] for name in FEATURES}
+        self.roi = None
+        self.frames = 0
+        self.recognition = None
+        self.liveness_report = pipelines.face_challenge_report([], [], [], [], [], challenge)
+
+    @property
+    def matched(self):
+        r = self.recognition
+        return r is not None and r['status'] == "Match" and r['name'] != "Unknown" and r['similarity'] > 0.5
+
+    @property
+    def unlocked(self):
+        return self.liveness_report['challenge_passed'] and self.matched
+
+    def update(self, result):
+        """Fold one stream_frame() result into the session."""
+        self.frames += 1
+        self.roi = result['roi']
+        if result['features'] is not None:
+            for name in FEATURES:
+                self.features[name].append(result['features'][name])
+            self.liveness_report = pipelines.face_challenge_report(
+                *(self.features[name] for name in FEATURES), self.challenge)
+        recognition = result['recognition']
+        if recognition is not None and (self.recognition is None or
+                                        recognition['similarity'] > self.recognition['similarity']):
+            self.recognition = recognition
+
+    def progress(self):
+        r = self.recognition
+        return {
+            "type": "progress",
+            "frame": self.frames,
+            "face": self.roi is not None,
+            "challenge_passed": self.liveness_report['challenge_passed'],
+            "identity": r['name'] if r else None,
+            "score": float(r['similarity']) if r else None
+        }
+
+    def verdict(self, reason):
+        r = self.recognition
+        return {
+            "type": "verdict",
+            "success": self.unlocked,
+            "reason": reason,
+            "frames": self.frames,
+            "liveness_report": self.liveness_report,
+            "recognition_result": None if r is None else {
+                "success": self.matched,
+                "identity": r['name'],
+                "score": float(r['similarity']),
+                "box": r['box'],
+                "processed_image": r['processed_image']
+            }
+        }
+
+
+async def _send(websocket, message):
+    """Send a JSON message; False if the client has already gone away."""
+    try:
+        await websocket.send_json(message)
+        return True
+    except (WebSocketDisconnect, RuntimeError):  # starlette raises RuntimeError once closed
+        return False
+
+
+async def _close(websocket, code=1000):
+    try:
+        await websocket.close(code=code)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+
+
+async def serve(websocket: WebSocket, execution, challenge, response="none", max_frame_bytes=None):
+    await websocket.accept()
+    if challenge not in CHALLENGES or response not in RESPONSE_MODES:
+        await _send(websocket, {
+            "type": "error",
+            "error": f"challenge must be one of: {', '.join(CHALLENGES)}; "
+                     f"response must be one of: {', '.join(RESPONSE_MODES)}"
+        })
+        await _close(websocket, code=1008)
+        return
+    session = UnlockSession(challenge)
+    latest = {"frame": None, "too_large": False}
+    arrived = asyncio.Event()
+
+    async def receive_frames():
+        # Keep only the newest frame; anything older is stale by the time a worker is free.
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                frame = message.get("bytes") or message.get("text")
+                if max_frame_bytes and frame and len(frame) > max_frame_bytes:
+                    latest["too_large"] = True
+                    break
+                latest["frame"] = frame
+                arrived.set()
+        finally:
+            arrived.set()
+
+    reader = asyncio.create_task(receive_frames())
+    try:
+        reason = "timeout"
+        while True:
+            try:
+                await asyncio.wait_for(arrived.wait(), session.deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            arrived.clear()
+            if latest["too_large"]:
+                logger.info("Unlock stream frame over %d bytes after %d frames.", max_frame_bytes, session.frames)
+                await _send(websocket, {"type": "error",
+                                        "error": f"Frames are limited to {max_frame_bytes} bytes."})
+                await _close(websocket, code=1009)
+                return
+            if reader.done():
+                logger.info("Unlock stream closed by client after %d frames.", session.frames)
+                return
+            frame, latest["frame"] = latest["frame"], None
+            if frame is None:
+                continue
+            try:
+                result = await execution.run_model(pipelines.stream_frame, frame, session.roi,
+                                                   not session.matched, response)
+            except ServerBusy:
+                continue  # drop this frame; the next one gets another chance
+            except Exception as e:
+                logger.exception("Exception while processing an unlock stream frame")
+                if not await _send(websocket, {"type": "error", "error": str(e)}):
+                    return
+                continue
+            session.update(result)
+            if session.unlocked:
+                reason = "unlocked"
+                break
+            if session.frames >= session.max_frames:
+                reason = "max_frames"
+                break
+            if not await _send(websocket, session.progress()):
+                logger.info("Unlock stream closed by client after %d frames.", session.frames)
+                return
+        logger.info("Unlock stream verdict after %d frames: %s", session.frames, reason)
+        if await _send(websocket, session.verdict(reason)):
+            await _close(websocket)
+    finally:
+        reader.cancel()
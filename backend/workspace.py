@@ -0,0 +1,120 @@
+"""
+Per-request scratch space for uploaded videos.
+
+Every request gets its own directory under a per-process root, so overlapping
+requests never share a file, and the directory is removed when the request
+finishes. Uploads are streamed to disk in chunks against two limits: a per-upload
+size cap and a quota on the total bytes held by all live workspaces.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import atexit
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, limit):
+        super().__init__(f"Upload exceeds the {limit // CHUNK_SIZE} MB limit.")
+
+
+class WorkspaceQuotaExceeded(Exception):
+    def __init__(self):
+        super().__init__("Scratch disk quota exhausted, please retry shortly.")
+        self.retry_after = 1
+
+
+class Workspace:
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        self.bytes_used = 0
+        self.digests = {}  # saved path -> SHA-256 of its content
+        self._holds = 1  # the request's own; see hold()
+
+    def save_upload(self, upload, filename, max_bytes=None):
+        """Stream an UploadFile into the workspace and return the saved path; its hash goes in `digests`."""
+        path = os.path.join(self.path, os.path.basename(filename))
+        max_bytes = max_bytes or self.manager.max_upload_bytes
+        written = 0
+        digest = hashlib.sha256()
+        with open(path, "wb") as buffer:
+            while True:
+                chunk = upload.file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                self.manager._reserve(len(chunk))
+                self.bytes_used += len(chunk)
+                buffer.write(chunk)
+                digest.update(chunk)
+        self.digests[path] = digest.hexdigest()
+        return path
+
+    def cleanup(self):
+        self.manager._release(self.bytes_used)
+        self.bytes_used = 0
+        if self.manager.keep:
+            logger.warning("Keeping request workspace for debugging: %s", self.path)
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def hold(self):
+        """Keep the files past the request, for a job that can outlive it; release() when done."""
+        self._holds += 1
+
+    def release(self):
+        self._holds -= 1
+        if not self._holds:
+            self.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class WorkspaceManager:
+    def __init__(self, parent_dir=None, quota_bytes=512 * CHUNK_SIZE, max_upload_bytes=64 * CHUNK_SIZE, keep=False):
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        # One root per server process; the whole tree goes away when the process exits.
+        self.root = tempfile.mkdtemp(prefix="face_unlock_", dir=parent_dir)
+        self.quota_bytes = quota_bytes
+        self.max_upload_bytes = max_upload_bytes
+        self.keep = keep
+        self.bytes_used = 0
+        self._lock = threading.Lock()
+        if not keep:
+            atexit.register(shutil.rmtree, self.root, True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            parent_dir=os.environ.get("FACE_WORKSPACE_DIR") or None,
+            quota_bytes=int(os.environ.get("FACE_WORKSPACE_QUOTA_MB", "512")) * CHUNK_SIZE,
+            max_upload_bytes=int(os.environ.get("FACE_MAX_UPLOAD_MB", "64")) * CHUNK_SIZE,
+            keep=os.environ.get("FACE_DEBUG_FRAMES") == "1",
+        )
+
+    def create(self):
+        return Workspace(self, tempfile.mkdtemp(prefix="req_", dir=self.root))
+
+    def _reserve(self, size):
+        with self._lock:
+            if self.bytes_used + size > self.quota_bytes:
+                raise WorkspaceQuotaExceeded()
+            self.bytes_used += size
+
+    def _release(self, size):
+        with self._lock:
+            self.bytes_used -= size